@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+Benchmark of the gain strategy lookup in :meth:`caf_find._Selector.runs_by_range`.
+
+Compares the old lookup (sort the strategy list and scan every interval for
+every run) with :class:`iov.IntervalIndex` (sort once, binary search per run).
+The old lookup is O(runs * intervals * log intervals), so it is timed on a
+sample of runs and extrapolated to the full number of runs.
+
+.. code-block:: bash
+
+    usage: bench_gain_index.py [-h] [-r RUNS] [-i INTERVALS] [-s SAMPLE]
+
+    Benchmark gain strategy lookup
+
+    optional arguments:
+      -h, --help            show this help message and exit
+      -r RUNS, --runs RUNS  Number of runs
+      -i INTERVALS, --intervals INTERVALS
+                            Number of strategy intervals
+      -s SAMPLE, --sample SAMPLE
+                            Number of runs used to time the linear scan
+
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import iov
+
+
+def _get_cli():
+    parser = argparse.ArgumentParser(description='Benchmark gain strategy lookup')
+    parser.add_argument('-r', '--runs', type=int, help="Number of runs", default=100000)
+    parser.add_argument('-i', '--intervals', type=int, help="Number of strategy intervals",
+                        default=10000)
+    parser.add_argument('-s', '--sample', type=int,
+                        help="Number of runs used to time the linear scan", default=20)
+    return parser.parse_args()
+
+
+def _generate(runs, intervals):
+    step = 1000000000 * 3600
+    gain_list = [
+        {'since': i * step, 'until': (i + 1) * step, 'payload': 'Gain%d' % (i % 3)}
+        for i in range(intervals)
+    ]
+    sortimes = [random.randint(0, intervals * step) for _ in range(runs)]
+    return gain_list, sortimes
+
+
+def _linear(gain_list, sortimes):
+    result = []
+    for sortime in sortimes:
+        value = None
+        for gain in sorted(gain_list, key=lambda g: g['since']):
+            if gain['since'] <= sortime <= gain['until']:
+                value = gain['payload']
+        result.append(value)
+    return result
+
+
+def _indexed(gain_list, sortimes):
+    index = iov.IntervalIndex(
+        (gain['since'], gain['until'], gain['payload']) for gain in gain_list
+    )
+    return [index.find(sortime) for sortime in sortimes]
+
+
+def bench(runs, intervals, sample):
+    """ Time both lookups
+
+    Returns:
+        (float, float): seconds for the linear scan (extrapolated) and the index
+    """
+    gain_list, sortimes = _generate(runs, intervals)
+    sample = sortimes[:sample]
+
+    start = time.time()
+    expected = _linear(gain_list, sample)
+    linear = (time.time() - start) * runs / len(sample)
+
+    start = time.time()
+    result = _indexed(gain_list, sortimes)
+    indexed = time.time() - start
+
+    # Boundary points may match two intervals, both lookups take the later one
+    assert result[:len(sample)] == expected
+    return linear, indexed
+
+
+def _main():
+    cli = _get_cli()
+    print("%10s %10s %14s %12s %10s" % ('runs', 'intervals', 'linear, s', 'index, s', 'speedup'))
+    sizes = []
+    runs, intervals = cli.runs, cli.intervals
+    while runs >= 1000 and intervals >= 100:
+        sizes.append((runs, intervals))
+        runs, intervals = runs // 10, intervals // 10
+    for runs, intervals in reversed(sizes):
+        linear, indexed = bench(runs, intervals, cli.sample)
+        print("%10d %10d %14.3f %12.4f %10.0f" % (
+            runs, intervals, linear, indexed, linear / indexed))
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""
+Benchmark of storing found runs in the database by :mod:`caf_db_find`.
+
+Ingests synthetic runs with their files into a fresh database, then the
+same runs again as the next pass would, and compares it with creating
+every row separately.
+
+.. code-block:: bash
+
+    usage: bench_ingest.py [-h] [-r RUNS] [-f FILES] [-b BATCH] [--rows ROWS]
+
+    Benchmark database ingest
+
+    optional arguments:
+      -h, --help            show this help message and exit
+      -r RUNS, --runs RUNS  Number of runs
+      -f FILES, --files FILES
+                            Number of files of every run
+      -b BATCH, --batch BATCH
+                            Number of runs stored in one transaction
+      --rows ROWS           Number of runs stored row by row for comparison
+
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import models
+import caf_files
+import caf_db_find
+
+FIRST_RUN = 272549
+LISTENERS = ['TileEnergyScan', 'LArEnergyScan']
+
+
+def _get_cli():
+    parser = argparse.ArgumentParser(description='Benchmark database ingest')
+    parser.add_argument('-r', '--runs', type=int, help="Number of runs", default=10000)
+    parser.add_argument('-f', '--files', type=int, help="Number of files of every run",
+                        default=50)
+    parser.add_argument('-b', '--batch', type=int, help="Number of runs stored in one transaction",
+                        default=caf_files.DEFAULT_JOBS)
+    parser.add_argument('--rows', type=int,
+                        help="Number of runs stored row by row for comparison", default=100)
+    return parser.parse_args()
+
+
+def _records(runs, files):
+    batch, found = [], {}
+    for i in range(runs):
+        run = FIRST_RUN + i
+        batch.append(({
+            'RunNumber': run, 'SORTime': i, 'EORTime': i + 1, 'RecordedEvents': 2241,
+            'EFEvents': 2236, 'RunType': 'cismono', 'GainStrategy': 'GainOne',
+            'PartitionName': 'L1CaloCombined'
+        }, LISTENERS))
+        found[run] = [
+            caf_files.FileInfo('/eos/%08d/data15_calib.%08d._%04d.data' % (run, run, j),
+                               1 << 30, 1435000000.0 + i, '0a0b0c0d')
+            for j in range(files)
+        ]
+    return batch, found
+
+
+def _connect(directory):
+    models.connect(os.path.join(directory, 'caf.db'), recreate=True)
+    return dict((name, models.Listener.create(Name=name)) for name in LISTENERS)
+
+
+def _ingest(batch, found, db_lsts, size):
+    pending = dict((name, set()) for name in LISTENERS)
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        for i in range(0, len(batch), size):
+            caf_db_find._ingest(batch[i:i + size], found, db_lsts, pending)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def _rows(batch, found, db_lsts):
+    for run, names in batch:
+        db_run = models.Run.create(**run)
+        for f in found[run['RunNumber']]:
+            models.File.create(Name=f.name, Run=db_run)
+        for name in names:
+            db_run.Listeners.add(db_lsts[name])
+
+
+def _report(label, runs, files, elapsed):
+    print("%-10s %8d runs %10d files %10.3f s %10.1f runs/s" % (
+        label, runs, runs * files, elapsed, runs / elapsed))
+
+
+def _main():
+    cli = _get_cli()
+    directory = tempfile.mkdtemp(prefix='caf_ingest_')
+    try:
+        batch, found = _records(cli.runs, cli.files)
+
+        db_lsts = _connect(directory)
+        start = time.time()
+        _ingest(batch, found, db_lsts, cli.batch)
+        _report('bulk', cli.runs, cli.files, time.time() - start)
+        assert models.File.select().count() == cli.runs * cli.files
+
+        start = time.time()
+        _ingest(batch, found, db_lsts, cli.batch)
+        _report('again', cli.runs, 0, time.time() - start)
+        assert models.Run.Listeners.get_through_model().select().count() == \
+            cli.runs * len(LISTENERS)
+
+        db_lsts = _connect(directory)
+        start = time.time()
+        _rows(batch[:cli.rows], found, db_lsts)
+        _report('rows', cli.rows, cli.files, time.time() - start)
+    finally:
+        models.db.close()
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""
+Benchmark of the file discovery in :mod:`caf_files` without EOS.
+
+Builds a synthetic directory tree with the EOS layout
+(`<root>/<run>/<dataset>/<file>`) and lists it with
+:class:`caf_files.FakeBackend`, so every strategy can be timed on any machine.
+
+.. code-block:: bash
+
+    usage: bench_listing.py [-h] [--roots ROOTS] [-r RUNS] [-d DATASETS]
+                            [-q QUERY] [-j JOBS] [--latency LATENCY]
+                            [--tree TREE]
+
+    Benchmark file discovery
+
+    optional arguments:
+      -h, --help            show this help message and exit
+      --roots ROOTS         Number of scan roots
+      -r RUNS, --runs RUNS  Number of runs in every root
+      -d DATASETS, --datasets DATASETS
+                            Number of datasets of every run
+      -q QUERY, --query QUERY
+                            Number of runs to look up
+      -j JOBS, --jobs JOBS  Number of concurrent listings
+      --latency LATENCY     Synthetic latency of every listing, s
+      --tree TREE           Tree path, generated if it doesn't exist
+
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import caf_files
+
+FIRST_RUN = 272549
+
+
+def _get_cli():
+    parser = argparse.ArgumentParser(description='Benchmark file discovery')
+    parser.add_argument('--roots', type=int, help="Number of scan roots", default=5)
+    parser.add_argument('-r', '--runs', type=int, help="Number of runs in every root",
+                        default=10000)
+    parser.add_argument('-d', '--datasets', type=int, help="Number of datasets of every run",
+                        default=3)
+    parser.add_argument('-q', '--query', type=int, help="Number of runs to look up",
+                        default=1000)
+    parser.add_argument('-j', '--jobs', type=int, help="Number of concurrent listings",
+                        default=caf_files.DEFAULT_JOBS)
+    parser.add_argument('--latency', type=float,
+                        help="Synthetic latency of every listing, s", default=0.002)
+    parser.add_argument('--tree', help="Tree path, generated if it doesn't exist")
+    return parser.parse_args()
+
+
+def make_tree(path, roots, runs, datasets, first=FIRST_RUN):
+    """ Build a synthetic tree, a run belongs to one root only
+
+    Args:
+        path (string): tree directory
+        roots (int): number of scan roots
+        runs (int): number of runs in every root
+        datasets (int): number of datasets of every run
+        first (Optional[int]): first run number
+
+    Returns:
+        [string]: root paths
+    """
+    paths = [os.path.join(path, 'root%d' % i, '') for i in range(roots)]
+    for i in range(runs * roots):
+        run = first + i
+        run_path = os.path.join(paths[i % roots], '%08d' % run)
+        for j in range(datasets):
+            dataset = os.path.join(run_path, 'data15_calib.%08d.ds%d' % (run, j))
+            os.makedirs(dataset)
+            open(os.path.join(dataset, 'data15_calib.%08d._0001.data' % run), 'w').close()
+    return paths
+
+
+def _time(label, func):
+    start = time.time()
+    result = func()
+    elapsed = time.time() - start
+    print("%-10s %8d runs %10.3f s %10.1f runs/s" % (label, len(result), elapsed,
+                                                     len(result) / elapsed))
+    return result
+
+
+def _main():
+    cli = _get_cli()
+    tree = cli.tree or tempfile.mkdtemp(prefix='caf_tree_')
+    start = time.time()
+    if os.path.exists(os.path.join(tree, 'root0')):
+        paths = [os.path.join(tree, 'root%d' % i, '') for i in range(cli.roots)]
+    else:
+        paths = make_tree(tree, cli.roots, cli.runs, cli.datasets)
+    print("%-10s %8d runs %10.3f s" % ('tree', cli.runs * cli.roots, time.time() - start))
+
+    backend = caf_files.FakeBackend(cli.latency)
+    # Runs spread over the tree, some of them don't exist
+    step = max(1, cli.runs * cli.roots // cli.query)
+    runs = range(FIRST_RUN, FIRST_RUN + step * cli.query + step, step)[:cli.query]
+    cache = caf_files.ListingCache(os.path.join(tree, 'cache.db'))
+    cache.invalidate()
+    try:
+        serial = _time('serial', lambda: dict(
+            (run, caf_files.get_files(run, paths, backend=backend)) for run in runs
+        ))
+        parallel = _time('parallel', lambda: caf_files.get_files_many(
+            runs, paths, cli.jobs, backend=backend
+        ))
+        _time('cold cache', lambda: caf_files.get_files_many(
+            runs, paths, cli.jobs, cache=cache, backend=backend
+        ))
+        cached = _time('warm cache', lambda: caf_files.get_files_many(
+            runs, paths, cli.jobs, cache=cache, backend=backend
+        ))
+        bulk = _time('bulk', lambda: caf_files.get_files_many(
+            runs, paths, bulk=True, backend=backend
+        ))
+        assert serial == parallel == cached == bulk
+    finally:
+        cache.close()
+        if not cli.tree:
+            shutil.rmtree(tree)
+
+if __name__ == '__main__':
+    _main()
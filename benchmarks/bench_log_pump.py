@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Benchmark of the log pump of :mod:`caf_submit` for chatty jobs.
+
+A synthetic launcher prints many lines to stdout, as athena does, and some
+to stderr. The job is run by :func:`caf_submit.run_local` and by the former
+line-by-line loop, which reads stdout only and echoes every line. Reports
+the wall time and the CPU used by the wrapper process itself.
+
+.. code-block:: bash
+
+    usage: bench_log_pump.py [-h] [-n LINES] [-w WIDTH] [-e ECHO]
+
+    Benchmark job log pump
+
+    optional arguments:
+      -h, --help            show this help message and exit
+      -n LINES, --lines LINES
+                            Number of lines printed by the job
+      -w WIDTH, --width WIDTH
+                            Characters per line
+      -e ECHO, --echo ECHO  Echo interval of the pump, s
+
+"""
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import caf_submit
+
+LAUNCHER = """#!/bin/bash
+python -c "
+import sys
+line = 'x' * %(width)d + '\\n'
+for i in xrange(%(lines)d):
+    sys.stdout.write(line)
+    if not i %% 1000:
+        sys.stderr.write('warning %%d\\n' %% i)
+"
+"""
+
+
+def _get_cli():
+    parser = argparse.ArgumentParser(description='Benchmark job log pump')
+    parser.add_argument('-n', '--lines', type=int, help="Number of lines printed by the job",
+                        default=1000000)
+    parser.add_argument('-w', '--width', type=int, help="Characters per line", default=100)
+    parser.add_argument('-e', '--echo', type=float, help="Echo interval of the pump, s",
+                        default=1.0)
+    return parser.parse_args()
+
+
+def _readline(folder):
+    """ The former local job of caf_submit """
+    p = subprocess.Popen([caf_submit._get_launcher(folder)], stdout=subprocess.PIPE,
+                         stderr=open(os.devnull, 'w'))
+    with open(os.path.join(folder, 'log.out'), 'w') as log:
+        while p.poll() is None:
+            l = p.stdout.readline()
+            print l,
+            log.write(l)
+        last = p.stdout.read()
+        print last
+        log.write(last)
+
+
+def _time(label, func, folder):
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    stderr, sys.stderr = sys.stderr, sys.stdout
+    before = os.times()
+    try:
+        func(folder)
+    finally:
+        after = os.times()
+        sys.stdout.close()
+        sys.stdout, sys.stderr = stdout, stderr
+    size = os.path.getsize(os.path.join(folder, 'log.out'))
+    print("%-10s %10.3f s wall %10.3f s CPU %12d bytes logged" % (
+        label, after[4] - before[4], after[0] + after[1] - before[0] - before[1], size))
+
+
+def _main():
+    cli = _get_cli()
+    folder = tempfile.mkdtemp(prefix='caf_pump_')
+    try:
+        launcher = caf_submit._get_launcher(folder)
+        with open(launcher, 'w') as f:
+            f.write(LAUNCHER % {'lines': cli.lines, 'width': cli.width})
+        os.chmod(launcher, 0755)
+        _time('readline', _readline, folder)
+        _time('pump', lambda path: caf_submit.run_local([path], slots=1, echo=cli.echo), folder)
+        _time('pump echo', lambda path: caf_submit.run_local([path], slots=1, echo=0), folder)
+    finally:
+        shutil.rmtree(folder)
+
+if __name__ == '__main__':
+    _main()
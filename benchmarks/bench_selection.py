@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""
+Benchmark of the run selection in :mod:`caf_find` without COOL.
+
+Generates a synthetic JSON-lines fixture (SOR, EOR, EventCounters and Strategy
+folders) and replays it with :class:`conditions.LocalBackend`, so the whole
+selection path can be timed on any machine.
+
+.. code-block:: bash
+
+    usage: bench_selection.py [-h] [-r RUNS] [--latency LATENCY]
+                              [--fixture FIXTURE]
+
+    Benchmark run selection
+
+    optional arguments:
+      -h, --help         show this help message and exit
+      -r RUNS, --runs RUNS
+                         Number of runs in the fixture
+      --latency LATENCY  Synthetic latency of every round trip, s
+      --fixture FIXTURE  Fixture path, generated if it doesn't exist
+
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import conditions
+import caf_find
+
+FIRST_RUN = 272549
+RUN_TYPES = ['cismono', 'LarCalibL1Calo', 'Physics', 'Pedestal']
+PARTITIONS = ['L1CaloCombined', 'TileL1CaloCombined', 'LArgL1CaloCombined', 'ATLAS']
+
+
+def _get_cli():
+    parser = argparse.ArgumentParser(description='Benchmark run selection')
+    parser.add_argument('-r', '--runs', type=int, help="Number of runs in the fixture",
+                        default=20000)
+    parser.add_argument('--latency', type=float,
+                        help="Synthetic latency of every round trip, s", default=0.05)
+    parser.add_argument('--fixture', help="Fixture path, generated if it doesn't exist")
+    return parser.parse_args()
+
+
+def make_fixture(stream, runs, first=FIRST_RUN, open_runs=1):
+    """ Write a synthetic fixture for :class:`conditions.LocalBackend`
+
+    Every fifth run is a calibration run, the last `open_runs` runs have no
+    EOR record yet and the gain strategy changes every 50 runs.
+
+    Args:
+        stream (file): output stream
+        runs (int): number of runs
+        first (Optional[int]): first run number
+        open_runs (Optional[int]): number of runs without EOR
+    """
+    second = 1000000000
+    start = 1435000000 * second
+
+    def write(db, folder, since, until, payload, channel=0):
+        stream.write(json.dumps({
+            'db': db, 'folder': folder, 'channel': channel,
+            'since': since, 'until': until, 'payload': payload
+        }) + '\n')
+
+    tdaq, trig = "COOLONL_TDAQ/CONDBR2", "COOLONL_TRIGGER/CONDBR2"
+    for i in range(runs):
+        run = first + i
+        sortime = start + i * 3600 * second
+        since, until = run << 32, (run + 1) << 32
+        write(tdaq, '/TDAQ/RunCtrl/SOR', since, until, {
+            'RunNumber': run,
+            'SORTime': sortime,
+            'RunType': RUN_TYPES[i % 5 % len(RUN_TYPES)],
+            'PartitionName': PARTITIONS[i % len(PARTITIONS)],
+            'RecordingEnabled': True,
+            'DAQConfiguration': 'Schema=360:Data=81',
+            'DetectorMask': '00000000000000000000280400f00000',
+            'T0ProjectTag': 'data15_calib'
+        })
+        if i < runs - open_runs:
+            write(tdaq, '/TDAQ/RunCtrl/EOR', since, until, {
+                'RunNumber': run,
+                'EORTime': sortime + 600 * second,
+                'TotalTime': 600,
+                'CleanStop': i % 7 != 0
+            })
+            write(tdaq, '/TDAQ/RunCtrl/EventCounters', since, until, {
+                'L1Events': 2241,
+                'L2Events': 0,
+                'EFEvents': 2236,
+                'RecordedEvents': 2241 if i % 3 else 100
+            })
+    for i in range(0, runs, 50):
+        for channel in (0, 1):
+            write(trig, '/TRIGGER/Receivers/Conditions/Strategy',
+                  start + i * 3600 * second, start + (i + 50) * 3600 * second,
+                  {'name': 'GainOne' if i % 100 else 'CalibGainsEt'}, channel)
+
+
+def _time(label, backend, **argw):
+    start = time.time()
+    runs = caf_find.get_runs(
+        run=FIRST_RUN, loglevel='ERROR', runtype='cismono',
+        partitions=['L1CaloCombined', 'TileL1CaloCombined'],
+        recenabled=True, cleanstop=True, minevents=1700, backend=backend, **argw
+    )
+    print("%-12s %8d runs %10.3f s" % (label, len(runs), time.time() - start))
+    return runs
+
+
+def _main():
+    cli = _get_cli()
+    fixture = cli.fixture
+    if not fixture:
+        fixture = os.path.join(tempfile.gettempdir(), 'caf_fixture_%d.jsonl' % cli.runs)
+    if not os.path.exists(fixture):
+        with open(fixture, 'w') as stream:
+            make_fixture(stream, cli.runs)
+
+    start = time.time()
+    backend = conditions.LocalBackend(fixture, latency=cli.latency)
+    print("%-12s %8d runs %10.3f s" % ('load', cli.runs, time.time() - start))
+
+    serial = _time('serial', backend)
+    concurrent = _time('concurrent', backend, concurrent=True)
+    assert serial == concurrent
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+"""
+Benchmark of concurrent access to the CAF database with every pragmas
+profile of :data:`models.PROFILES`.
+
+A writer process stores batches of runs with their files as
+:mod:`caf_db_find` does, while reader processes count files of every run.
+Reports writer commits, reader queries and the worst reader latency.
+
+.. code-block:: bash
+
+    usage: bench_sqlite.py [-h] [-d DURATION] [-r READERS] [-b BATCH]
+                           [-f FILES] [--dir DIR]
+
+    Benchmark database concurrency
+
+    optional arguments:
+      -h, --help            show this help message and exit
+      -d DURATION, --duration DURATION
+                            Seconds to run every profile
+      -r READERS, --readers READERS
+                            Number of reader processes
+      -b BATCH, --batch BATCH
+                            Number of runs stored in one transaction
+      -f FILES, --files FILES
+                            Number of files of every run
+      --dir DIR             Directory for the database, e.g. to test a
+                            network filesystem
+
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import models
+import peewee
+
+FIRST_RUN = 272549
+
+
+def _get_cli():
+    parser = argparse.ArgumentParser(description='Benchmark database concurrency')
+    parser.add_argument('-d', '--duration', type=float, help="Seconds to run every profile",
+                        default=5)
+    parser.add_argument('-r', '--readers', type=int, help="Number of reader processes",
+                        default=2)
+    parser.add_argument('-b', '--batch', type=int, help="Number of runs stored in one transaction",
+                        default=8)
+    parser.add_argument('-f', '--files', type=int, help="Number of files of every run",
+                        default=50)
+    parser.add_argument('--dir', help="Directory for the database, e.g. to test a "
+                        "network filesystem")
+    return parser.parse_args()
+
+
+def _writer(path, profile, deadline, batch, files, result):
+    models.connect(path, profile=profile)
+    listener = models.Listener.get(models.Listener.Name == 'bench')
+    through = models.Run.Listeners.get_through_model()
+    run, commits, errors = FIRST_RUN, 0, 0
+    while time.time() < deadline:
+        numbers = range(run, run + batch)
+        try:
+            with models.db.atomic():
+                models.bulk_insert(models.Run, [{
+                    'RunNumber': number, 'SORTime': 0, 'EORTime': 0, 'RecordedEvents': 0,
+                    'EFEvents': 0, 'RunType': 'cismono', 'GainStrategy': 'GainOne',
+                    'PartitionName': 'L1CaloCombined'
+                } for number in numbers])
+                ids = dict(models.Run.select(models.Run.RunNumber, models.Run.id)
+                           .where(models.Run.RunNumber << numbers).tuples())
+                models.bulk_insert(models.File, [
+                    {'Name': '/eos/%08d/%d.data' % (number, i), 'Run': ids[number]}
+                    for number in numbers for i in range(files)
+                ])
+                models.bulk_insert(through, [
+                    {'run': ids[number], 'listener': listener.id} for number in numbers
+                ])
+            commits += 1
+            run += batch
+        except peewee.OperationalError:
+            errors += 1
+    result.put(('writer', commits, errors, 0.0))
+
+
+def _reader(path, profile, deadline, result):
+    models.connect(path, profile=profile)
+    queries, errors, worst = 0, 0, 0.0
+    while time.time() < deadline:
+        start = time.time()
+        try:
+            # Files per run of the whole database, as a status page shows
+            list(models.Run
+                 .select(models.Run.RunNumber, peewee.fn.Count(models.File.id))
+                 .join(models.File)
+                 .group_by(models.Run.RunNumber)
+                 .tuples())
+            queries += 1
+        except peewee.OperationalError:
+            errors += 1
+        worst = max(worst, time.time() - start)
+    result.put(('reader', queries, errors, worst))
+
+
+def _bench(directory, profile, cli):
+    path = os.path.join(directory, '%s.db' % profile)
+    models.connect(path, recreate=True, profile=profile)
+    models.Listener.create(Name='bench')
+    models.db.close()
+
+    result = multiprocessing.Queue()
+    deadline = time.time() + cli.duration
+    procs = [multiprocessing.Process(
+        target=_writer, args=(path, profile, deadline, cli.batch, cli.files, result)
+    )] + [multiprocessing.Process(
+        target=_reader, args=(path, profile, deadline, result)
+    ) for _ in range(cli.readers)]
+    for proc in procs:
+        proc.start()
+    stats = [result.get() for _ in procs]
+    for proc in procs:
+        proc.join()
+
+    commits = sum(count for kind, count, _, _ in stats if kind == 'writer')
+    queries = sum(count for kind, count, _, _ in stats if kind == 'reader')
+    errors = sum(error for _, _, error, _ in stats)
+    worst = max(latency for _, _, _, latency in stats)
+    print("%-12s %10.1f commits/s %10.1f queries/s %8d errors %10.3f s worst read" % (
+        profile, commits / cli.duration, queries / cli.duration, errors, worst))
+
+
+def _main():
+    cli = _get_cli()
+    directory = tempfile.mkdtemp(prefix='caf_sqlite_', dir=cli.dir)
+    try:
+        for profile in sorted(models.PROFILES, reverse=True):
+            _bench(directory, profile, cli)
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    _main()
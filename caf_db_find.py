@@ -6,7 +6,9 @@ Search parameters are defined in :mod:`settings` module.
 Uses database schema defined in :mod:`model`
 
 .. code-block:: bash
-    usage: caf_db_find.py [-h] [-l {ERROR,WARNING,INFO,DEBUG,VERBOSE}] [-r]
+    usage: caf_db_find.py [-h] [-l {ERROR,WARNING,INFO,DEBUG,VERBOSE}] [-r] [-f]
+                          [--concurrent] [--refresh] [-j JOBS] [-b]
+                          [--profile {performance,safe}]
 
     Find runs by the specified creterias
 
@@ -15,10 +17,37 @@ Uses database schema defined in :mod:`model`
       -l {ERROR,WARNING,INFO,DEBUG,VERBOSE}, --log {ERROR,WARNING,INFO,DEBUG,VERBOSE}
                             Logging level
       -r, --recreate        Recreate database
+      -f, --full            Ignore saved high-water marks and search from the
+                            initial run of each listener
+      --concurrent          Browse EOR, EventCounters and Strategy folders
+                            concurrently
+      --refresh             Drop the cached COOL payloads and EOS listings
+                            before the search
+      -j JOBS, --jobs JOBS  Maximum number of concurrent EOS listings
+      -b, --bulk            Index files with one recursive listing per EOS
+                            path instead of listing every run directory
+      --profile {performance,safe}
+                            SQLite pragmas profile, use `safe` if the database
+                            is on AFS or NFS. By default the journal mode of
+                            the database is kept
 
+Each listener remembers the last fully processed run (see :class:`models.ScanMark`),
+so the next pass only browses COOL from there forward.
+
+COOL payloads of ended runs are cached in `cool_cache.db` next to the database
+(see :class:`conditions.RunCache`), COOL is only browsed for the runs that
+are not cached or were still open.
+
+EOS directory listings are cached in `eos_cache.db` (see :class:`caf_files.ListingCache`):
+missing run directories and incomplete datasets are listed again only after
+a while, complete datasets never. With `--bulk` all files are indexed once
+per pass instead (see :func:`caf_files.index_files`), which is cheaper when
+many runs are searched. Runs below the listeners' first runs aren't indexed
+and a path that can't be listed is skipped.
 
 """
 # ======================================================================
+import os
 import json
 import argparse
 # import pdb
@@ -29,6 +58,7 @@ import peewee
 # ======================================================================
 import caf_find
 import caf_files
+import conditions
 # ======================================================================
 
 
@@ -41,52 +71,206 @@ def _get_cli():
                         help="Logging level", default='ERROR')
     parser.add_argument('-r', '--recreate', action='store_true',
                         help="Recreate database", default=False)
+    parser.add_argument('-f', '--full', action='store_true',
+                        help="Ignore saved high-water marks and search from the "
+                             "initial run of each listener", default=False)
+    parser.add_argument('--concurrent', action='store_true',
+                        help="Browse EOR, EventCounters and Strategy folders concurrently")
+    parser.add_argument('--refresh', action='store_true',
+                        help="Drop the cached COOL payloads and EOS listings before the search",
+                        default=False)
+    parser.add_argument('-j', '--jobs', type=int,
+                        help="Maximum number of concurrent EOS listings",
+                        default=caf_files.DEFAULT_JOBS)
+    parser.add_argument('-b', '--bulk', action='store_true',
+                        help="Index files with one recursive listing per EOS path instead "
+                        "of listing every run directory", default=False)
+    parser.add_argument('--profile', choices=sorted(models.PROFILES),
+                        help="SQLite pragmas profile, use `safe` if the database is on "
+                        "AFS or NFS. By default the journal mode of the database is kept")
     return parser.parse_args()
 # ======================================================================
 
 
-def _process_listener(lst, loglevel):
-    runs = caf_find.get_runs(
-        run=lst['initialrun'],
-        loglevel=loglevel,
-        runtype=lst['runtype'],
-        partitions=lst['daqpartitions'],
-        recenabled=lst.get('reconly', True),
-        cleanstop=lst.get('cleanstop', True),
-        minevents=lst.get('minevents', 0)
-    )
+def _get_mark(db_lst):
+    try:
+        return models.ScanMark.get(models.ScanMark.Listener == db_lst)
+    except peewee.DoesNotExist:
+        return None
+
+
+def _save_mark(db_lst, mark):
+    if not mark:
+        return
+    db_mark = _get_mark(db_lst)
+    if db_mark is None:
+        db_mark = models.ScanMark(Listener=db_lst)
+    db_mark.LastRun, db_mark.LastSORTime = mark
+    db_mark.save()
+# ======================================================================
+
 
+def _get_listener(lst):
     try:
-        db_lst = models.Listener.get(models.Listener.Name == lst['name'])
+        return models.Listener.get(models.Listener.Name == lst['name'])
     except peewee.DoesNotExist:
-        db_lst = models.Listener.create(Name=lst['name'])
+        return models.Listener.create(Name=lst['name'])
 
-    for run in runs:
-        files = caf_files.get_files(run['RunNumber'])
-        if not files:
-            print("Could not find files for run %d" % run['RunNumber'])
+
+def _run_ids(numbers):
+    """ Ids of the stored runs, run number -> id """
+    ids = {}
+    for i in range(0, len(numbers), models.SQLITE_MAX_VARIABLES):
+        query = (models.Run
+                 .select(models.Run.id, models.Run.RunNumber)
+                 .where(models.Run.RunNumber << numbers[i:i + models.SQLITE_MAX_VARIABLES]))
+        for db_run in query:
+            ids[db_run.RunNumber] = db_run.id
+    return ids
+
+
+def _ingest(batch, files, db_lsts, pending):
+    """ Store a batch of runs with their files and link them to the listeners
+
+    New runs and their files are inserted in bulk, links that exist already
+    are ignored. Everything is written in one transaction.
+
+    Args:
+        batch ([(dict, [string])]): run records with names of their listeners
+        files (dict): run number -> [caf_files.FileInfo]
+        db_lsts (dict): listener name -> models.Listener
+        pending (dict): listener name -> run numbers to look at again
+    """
+    found = []
+    for run, names in batch:
+        if files[run['RunNumber']]:
+            found.append((run, names))
             continue
-        try:
-            db_run = models.Run.get(models.Run.RunNumber == run['RunNumber'])
-        except peewee.DoesNotExist:
-            db_run = models.Run.create(**run)
-            for f in files:
-                db_file = models.File.create(Name=f, Run=db_run)
-        run_lst = [l for l in db_run.Listeners if l.Name == db_lst.Name]
-        if not run_lst:
-            db_run.Listeners.add(db_lst)
-
-    print(json.dumps(runs, indent=2))
+        print("Could not find files for run %d" % run['RunNumber'])
+        for name in names:
+            pending[name].add(run['RunNumber'])
+    if not found:
+        return
+
+    with models.db.atomic():
+        ids = _run_ids([run['RunNumber'] for run, _ in found])
+        new = [run for run, _ in found if run['RunNumber'] not in ids]
+        # Records carry more COOL attributes than the model stores
+        models.bulk_insert(models.Run, [
+            dict((key, value) for key, value in run.iteritems()
+                 if key in models.Run._meta.fields)
+            for run in new
+        ])
+        ids.update(_run_ids([run['RunNumber'] for run in new]))
+        models.bulk_insert(models.File, [
+            {'Name': f.name, 'Run': ids[run['RunNumber']], 'Size': f.size,
+             'MTime': f.mtime, 'Checksum': f.checksum}
+            for run in new for f in files[run['RunNumber']]
+        ])
+        models.bulk_insert(models.Run.Listeners.get_through_model(), [
+            {'run': ids[run['RunNumber']], 'listener': db_lsts[name].id}
+            for run, names in found for name in names
+        ], ignore=True)
+
+    for run, _ in found:
+        print(json.dumps(run, indent=2))
+
+
+def _batches(runs, size):
+    """ Group a stream of runs into lists of `size` runs """
+    batch = []
+    for run in runs:
+        batch.append(run)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _by_run(runs):
+    """ Turn listener name -> runs into (run, listener names) ordered by run """
+    result = {}
+    for name, records in runs.iteritems():
+        for record in records:
+            result.setdefault(record['RunNumber'], (record, []))[1].append(name)
+    return [result[run] for run in sorted(result)]
+
+
+def _process_listeners(listeners, loglevel, full=False, concurrent=False, cache=None,
+                       jobs=caf_files.DEFAULT_JOBS, listing_cache=None, bulk=False):
+    db_lsts = {}
+    first_runs = {}
+    for lst in listeners:
+        db_lst = db_lsts[lst['name']] = _get_listener(lst)
+        db_mark = None if full else _get_mark(db_lst)
+        first_runs[lst['name']] = lst['initialrun']
+        if db_mark:
+            first_runs[lst['name']] = max(lst['initialrun'], db_mark.LastRun + 1)
+
+    # One COOL pass for all listeners. Without concurrent browsing the runs
+    # are streamed, so files of the first runs are looked up while COOL is
+    # still being read
+    scan = {}
+    if concurrent:
+        runs = _by_run(caf_find.get_runs_by_scans(
+            listeners, loglevel, runs=first_runs, scan=scan, concurrent=True,
+            cache=cache
+        ))
+    else:
+        runs = caf_find.iter_runs_by_scans(
+            listeners, loglevel, runs=first_runs, scan=scan, cache=cache
+        )
+
+    # Runs that are still open or don't have files yet are looked at again
+    pending = dict((lst['name'], set()) for lst in listeners)
+    # All EOS paths are indexed once, or directories of a batch of runs
+    # are listed concurrently
+    index = None
+    if bulk:
+        index = caf_files.index_files(
+            details=True, first_run=min(first_runs.values()) if first_runs else None
+        )
+    for batch in _batches(runs, jobs):
+        numbers = [run['RunNumber'] for run, _ in batch]
+        if index is not None:
+            files = dict((number, index.get(number, [])) for number in numbers)
+        else:
+            files = caf_files.get_files_many(numbers, jobs=jobs, cache=listing_cache,
+                                             details=True)
+        _ingest(batch, files, db_lsts, pending)
+
+    for lst in listeners:
+        _save_mark(db_lsts[lst['name']], caf_find.high_water_mark(
+            scan[lst['name']]['seen'],
+            pending[lst['name']] | scan[lst['name']]['open'],
+            lst.get('lookback', caf_find.DEFAULT_LOOKBACK)
+        ))
 # ======================================================================
 
 
 def _main():
     cli = _get_cli()
-    models.connect(recreate=cli.recreate)
+    models.connect(recreate=cli.recreate, profile=cli.profile)
+    db_dir = os.path.dirname(models.db.database)
+    cache = conditions.RunCache(os.path.join(db_dir, 'cool_cache.db'))
+    listing_cache = caf_files.ListingCache(os.path.join(db_dir, 'eos_cache.db'))
+    if cli.refresh:
+        cache.invalidate()
+        listing_cache.invalidate()
 
-    for listener in settings.SCANS:
-        if listener.get('enabled', True):
-            _process_listener(listener, cli.log)
+    _process_listeners(
+        [lst for lst in settings.SCANS if lst.get('enabled', True)],
+        cli.log,
+        cli.full,
+        cli.concurrent,
+        cache,
+        cli.jobs,
+        listing_cache,
+        cli.bulk
+    )
+    cache.close()
+    listing_cache.close()
 # ======================================================================
 
 if __name__ == '__main__':
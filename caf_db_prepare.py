@@ -2,35 +2,104 @@
 """
 Prepare job options' files for the runs from database
 
-.. todo::
-    IN PROGRESS
+.. code-block:: bash
+
+    usage: caf_db_prepare.py [-h] [-l {ERROR,WARNING,INFO,DEBUG,VERBOSE}] -o
+                             OUTPUT [-d] [-r RUN] [-a ASETUP] [-b BATCH]
+                             [--lease LEASE] [--retries RETRIES]
+                             [--profile {performance,safe}]
+
+    Prepare job options for analysis
+
+    optional arguments:
+      -h, --help            show this help message and exit
+      -l {ERROR,WARNING,INFO,DEBUG,VERBOSE}, --log {ERROR,WARNING,INFO,DEBUG,VERBOSE}
+                            Logging level
+      -o OUTPUT, --output OUTPUT
+                            Output directory
+      -d, --dry             Dry run - create options, but not update status in
+                            database
+      -r RUN, --run RUN     Prepare only for selected run
+      -a ASETUP, --asetup ASETUP
+                            asetup string, if the analysis doesn't define it
+      -b BATCH, --batch BATCH
+                            Number of jobs claimed at once
+      --lease LEASE         Seconds after which jobs claimed by this worker are
+                            prepared again by others if it dies
+      --retries RETRIES     Number of times a run is prepared again after its
+                            job has failed
+      --profile {performance,safe}
+                            SQLite pragmas profile, use `safe` if the database
+                            is on AFS or NFS. By default the journal mode of
+                            the database is kept
+
+Job options of an analysis and a run go to `OUTPUT/<analysis>/<run>`
+(see :func:`job_folder`). Runs with a job of the analysis are skipped,
+unless the job has failed. A run is prepared again at most RETRIES times.
+
+New jobs are claimed in batches (see :meth:`models.Job.claim`), so several
+workers can prepare jobs of the same database in parallel.
 
 """
 # ======================================================================
+import os
 import argparse
 # ======================================================================
-import peewee
-# ======================================================================
 import settings
 import caf_prepare
 import models
 # ======================================================================
 
+DEFAULT_BATCH = 16
+""" Default number of jobs claimed at once """
+DEFAULT_LEASE = 3600
+""" Default seconds after which a claimed job is given to another worker """
+DEFAULT_RETRIES = 2
+""" Default number of times a run is prepared again after its job has failed """
+# ======================================================================
+
 
 def _get_cli():
     parser = argparse.ArgumentParser(description='Prepare job options for analysis')
     parser.add_argument('-l', '--log',
                         choices=['ERROR', 'WARNING', 'INFO', 'DEBUG', 'VERBOSE'],
                         help="Logging level", default='ERROR')
-    parser.add_argument('-o', '--output', help="Output directory")
+    parser.add_argument('-o', '--output', help="Output directory", required=True)
     parser.add_argument('-d', '--dry',
                         help="Dry run - create options, but not update status in database",
                         action='store_true')
     parser.add_argument('-r', "--run", type=int, help="Prepare only for selected run")
+    parser.add_argument('-a', '--asetup', help="asetup string, if the analysis doesn't define it",
+                        default="20.1.7.2")
+    parser.add_argument('-b', '--batch', type=int, help="Number of jobs claimed at once",
+                        default=DEFAULT_BATCH)
+    parser.add_argument('--lease', type=float,
+                        help="Seconds after which jobs claimed by this worker are prepared "
+                        "again by others if it dies", default=DEFAULT_LEASE)
+    parser.add_argument('--retries', type=int,
+                        help="Number of times a run is prepared again after its job has failed",
+                        default=DEFAULT_RETRIES)
+    parser.add_argument('--profile', choices=sorted(models.PROFILES),
+                        help="SQLite pragmas profile, use `safe` if the database is on "
+                        "AFS or NFS. By default the journal mode of the database is kept")
 
     return parser.parse_args()
 
 
+def job_folder(output, analysis, run):
+    """ Folder of job options of the analysis and the run
+
+    Args:
+        output (string): output directory
+        analysis (string): analysis name
+        run (int): run number
+
+    Returns:
+        string: path
+    """
+    return os.path.join(output, analysis, "%08d" % run)
+
+
 def prepare_analysis(analysis, files, output, asetup=None, dry=False, run=None):
     """ Prepare job options' files for the runs from database
     Args:
@@ -45,26 +114,100 @@ def prepare_analysis(analysis, files, output, asetup=None, dry=False, run=None):
         jo=analysis['file'],
         files=files,
         output=output,
-        asetup=asetup,
+        asetup=analysis.get('asetup', asetup),
         postexec=analysis['postexec']
     )
 
-# def prepare(analyses, files, output, asetup=None, dry=False, run=None):
-#     models.connect()
-    # for ana in analyses:
-    #     for (run in models.Run.select().Join(model.Job, peewee.JOIN.LEFT_OUTER).where(
-    #         models.Job.Analysis == ana
-    #     ).count()):
-    #         prepare_analysis(ana, files, output, asetup, dry, run)
+
+def prepare(analyses, output, asetup=None, dry=False, run=None, batch=DEFAULT_BATCH,
+            lease=DEFAULT_LEASE, retries=DEFAULT_RETRIES):
+    """ Prepare job options of all runs lacking a job of the analyses
+
+    Jobs are created as NEW, then claimed in batches and moved to PREPARED,
+    or FAILED if their options can't be written.
+
+    Args:
+        analyses ([dict]): analyses configuration from :mod:`settings`
+        output (string): output directory
+        asetup (Optional(string)): asetup parameters
+        dry (Optional(bool)): if True then don't create jobs in the database
+        run (Optional(int)): run number
+        batch (Optional(int)): number of jobs claimed at once
+        lease (Optional(float)): seconds the claims of this worker last, see
+            :meth:`models.Job.claim`
+        retries (Optional(int)): number of times a run is prepared again
+            after its job has failed
+
+    Returns:
+        int: number of prepared jobs
+    """
+    by_name = dict((ana['name'], ana) for ana in analyses)
+    # Files of claimed jobs are fetched batch by batch
+    pairs = models.runs_needing_work(
+        sorted(by_name), statuses=models.Job.LIVE_STATUSES, run=run, files=dry,
+        failures=retries + 1
+    )
+    if dry:
+        for db_run, name in pairs:
+            prepare_analysis(by_name[name], [f.Name for f in db_run.Files_prefetch],
+                             job_folder(output, name, db_run.RunNumber), asetup, dry,
+                             db_run.RunNumber)
+        return len(pairs)
+
+    models.Job.enqueue(pairs)
+    models.Job.release_stale()
+    prepared = 0
+    for name in sorted(by_name):
+        while True:
+            jobs = models.Job.claim(models.Job.STATUS_NEW, batch, analysis=name, lease=lease)
+            if not jobs:
+                break
+            files = _files([job.Run_id for job in jobs])
+            for job in jobs:
+                prepared += _prepare_job(by_name[name], job, files[job.Run_id], output, asetup)
+    return prepared
+
+
+def _files(run_ids):
+    """ Names of files of the runs in one query, run id -> [string] """
+    files = dict((run_id, []) for run_id in run_ids)
+    query = (models.File
+             .select(models.File.Run, models.File.Name)
+             .where(models.File.Run << run_ids)
+             .order_by(models.File.id))
+    for run_id, name in query.tuples():
+        files[run_id].append(name)
+    return files
+
+
+def _prepare_job(analysis, job, files, output, asetup):
+    try:
+        prepare_analysis(analysis, files,
+                         job_folder(output, job.Analysis, job.Run.RunNumber), asetup,
+                         run=job.Run.RunNumber)
+    except (IOError, OSError) as err:
+        print("Failed to prepare %s for run %d: %s" % (job.Analysis, job.Run.RunNumber, err))
+        job.transition(models.Job.STATUS_FAILED)
+        return 0
+    if not job.transition(models.Job.STATUS_PREPARED):
+        print("Lost the claim of %s for run %d" % (job.Analysis, job.Run.RunNumber))
+        return 0
+    print("Prepared %s for run %d" % (job.Analysis, job.Run.RunNumber))
+    return 1
 
 
 def _main():
     cli = _get_cli()
-    prepare_analysis(
+    models.connect(profile=cli.profile)
+    prepare(
         analyses=settings.ANALYSIS,
         output=cli.output,
+        asetup=cli.asetup,
         dry=cli.dry,
-        run=cli.run
+        run=cli.run,
+        batch=cli.batch,
+        lease=cli.lease,
+        retries=cli.retries
     )
 
 if __name__ == '__main__':
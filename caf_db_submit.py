@@ -1,15 +1,402 @@
 #!/usr/bin/env python
 """
-Submit jobs from database
+Submit prepared jobs from database
 
-.. todo::
-    IN PROGRESS
+.. code-block:: bash
+
+    usage: caf_db_submit.py [-h] [-l {ERROR,WARNING,INFO,DEBUG,VERBOSE}] -o
+                            OUTPUT [-t {local,bsub}] [-j JOBS]
+                            [--analysis ANALYSIS] [-f] [--timeout TIMEOUT]
+                            [--lease LEASE] [--poll POLL] [-q QUEUE]
+                            [--lsf LSF] [--rss RSS]
+                            [--profile {performance,safe}] [--job-rss JOB_RSS]
+
+    Submit prepared jobs
+
+    optional arguments:
+      -h, --help            show this help message and exit
+      -l {ERROR,WARNING,INFO,DEBUG,VERBOSE}, --log {ERROR,WARNING,INFO,DEBUG,VERBOSE}
+                            Logging level
+      -o OUTPUT, --output OUTPUT
+                            Output directory of caf_db_prepare
+      -t {local,bsub}, --type {local,bsub}
+                            Submit engine
+      -j JOBS, --jobs JOBS  Maximum number of running jobs, of running bsub for
+                            bsub
+      --analysis ANALYSIS   Submit only jobs of the analysis
+      -f, --follow          Keep running and submit jobs prepared meanwhile
+      --timeout TIMEOUT     Seconds after which a running job is killed and
+                            failed
+      --lease LEASE         Seconds after which jobs of this scheduler are
+                            submitted again by others if it dies
+      --poll POLL           Seconds between checks for prepared jobs and polls
+                            of LSF
+      -q QUEUE, --queue QUEUE
+                            LSF queue
+      --lsf LSF             Command prepended to bsub and bjobs, e.g. "python
+                            fake_lsf.py" to run without LSF
+      --rss RSS             Memory budget of running local jobs, MiB
+      --profile {performance,safe}
+                            SQLite pragmas profile, use `safe` if the database
+                            is on AFS or NFS. By default the journal mode of
+                            the database is kept
+      --job-rss JOB_RSS     Expected peak memory of a local job, MiB, by default
+                            the largest of the last done jobs of the analysis
+
+PREPARED jobs are claimed (see :meth:`models.Job.claim`) while fewer than
+JOBS of them run. Their launchers run in the job folders
+(`OUTPUT/<analysis>/<run>`, see :func:`caf_db_prepare.job_folder`) and the
+jobs go to DONE or FAILED by the exit code. With `--rss` a job also waits
+until its expected memory fits into the budget.
+
+The exit code, wall and CPU time, peak memory of a local job and the size of
+its folder are recorded in the job (see :class:`models.Job`).
+
+With `-t bsub` the jobs are queued in LSF and their LSF job IDs are kept in
+the database. Queued jobs are polled until they end, also by a scheduler
+started later. Jobs LSF has already forgotten are finished by the LSF report
+in their `log.out` (see :meth:`caf_submit.LsfBackend.job_report`).
+
+The first SIGINT or SIGTERM stops claiming jobs, returns the claimed ones
+that haven't started to PREPARED and waits for the running ones, the second
+one kills them and returns them to PREPARED too. Running jobs stay claimed
+by the scheduler, if it dies they are submitted again by the next one after
+the lease.
 
 """
+# ======================================================================
+import time
+import signal
+import argparse
+import multiprocessing
+# ======================================================================
+import models
+import runner
+import caf_submit
+import caf_db_prepare
+# ======================================================================
+
+DEFAULT_LEASE = 600
+""" Default seconds after which jobs of a scheduler that has died are submitted again """
+DEFAULT_POLL = 5.0
+""" Default seconds between checks for prepared jobs """
+BSUB_TIMEOUT = 120
+""" Seconds after which a hanging bsub is killed and its job failed """
+# ======================================================================
+
+
+def _get_cli():
+    parser = argparse.ArgumentParser(description='Submit prepared jobs')
+    parser.add_argument('-l', '--log',
+                        choices=['ERROR', 'WARNING', 'INFO', 'DEBUG', 'VERBOSE'],
+                        help="Logging level", default='ERROR')
+    parser.add_argument('-o', '--output', help="Output directory of caf_db_prepare",
+                        required=True)
+    parser.add_argument(
+        '-t', '--type', help="Submit engine", choices=['local', 'bsub'], default='local')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help="Maximum number of running jobs, of running bsub for bsub",
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--analysis', help="Submit only jobs of the analysis")
+    parser.add_argument('-f', '--follow', help="Keep running and submit jobs prepared meanwhile",
+                        action='store_true')
+    parser.add_argument('--timeout', type=float,
+                        help="Seconds after which a running job is killed and failed")
+    parser.add_argument('--lease', type=float,
+                        help="Seconds after which jobs of this scheduler are submitted "
+                        "again by others if it dies", default=DEFAULT_LEASE)
+    parser.add_argument('--poll', type=float,
+                        help="Seconds between checks for prepared jobs and polls of LSF",
+                        default=DEFAULT_POLL)
+    parser.add_argument('-q', '--queue', help="LSF queue", default=caf_submit.DEFAULT_QUEUE)
+    parser.add_argument('--rss', type=int, help="Memory budget of running local jobs, MiB")
+    parser.add_argument('--profile', choices=sorted(models.PROFILES),
+                        help="SQLite pragmas profile, use `safe` if the database is on "
+                        "AFS or NFS. By default the journal mode of the database is kept")
+    parser.add_argument('--job-rss', type=int,
+                        help="Expected peak memory of a local job, MiB, by default the "
+                        "largest of the last done jobs of the analysis")
+    parser.add_argument('--lsf', help="Command prepended to bsub and bjobs, "
+                        "e.g. \"python fake_lsf.py\" to run without LSF")
+
+    return parser.parse_args()
+
+
+class Scheduler(object):
+    """ Runs prepared jobs, at most `limit` of them at once
+
+    With `bsub` all prepared jobs are queued in LSF, at most `limit`
+    submissions at once. Jobs queued by any scheduler are then polled with one
+    `bjobs` call per cycle, it runs alongside the submissions.
+
+    Args:
+        output (string): output directory of :mod:`caf_db_prepare`
+        limit (int): maximum number of running jobs
+        kind (Optional[string]): submit engine, see :func:`caf_submit.submit_many`
+        analysis (Optional[string]): only jobs of the analysis
+        timeout (Optional[float]): seconds, a job running longer is killed and fails
+        lease (Optional[float]): seconds, running jobs renew their claim
+            several times per lease
+        lsf (Optional[caf_submit.LsfBackend]): LSF backend of `bsub` jobs
+        rss (Optional[int]): memory budget of running local jobs, bytes,
+            unlimited by default
+        job_rss (Optional[int]): expected peak memory of a local job, bytes.
+            By default the largest of the last done jobs of the analysis
+            (see :meth:`models.Job.peak_rss`), or :data:`caf_submit.DEFAULT_JOB_RSS`
+    """
+    def __init__(self, output, limit, kind='local', analysis=None, timeout=None,
+                 lease=DEFAULT_LEASE, lsf=None, rss=None, job_rss=None):
+        self.output = output
+        self.kind = kind
+        self.analysis = analysis
+        self.timeout = timeout
+        self.lease = lease
+        self.lsf = lsf or caf_submit.LsfBackend()
+        self.job_rss = job_rss
+        # analysis -> expected peak memory of its jobs
+        self.peak_rss = {}
+        # Claimed jobs wait in the runner while the memory is short
+        self.runner = runner.Runner(limit, rss if kind == 'local' else None)
+        # command -> job
+        self.jobs = {}
+        self.stopping = False
+        self.killing = False
+        # Jobs queued in the batch system and their running `bjobs`
+        self.queued = 0
+        self.tracking = None
+        self.done = 0
+        self.failed = 0
+
+    def stop(self, kill=False):
+        """ Stop claiming jobs, also kill the running ones if `kill`
+
+        Only flags are set, so it can be called from a signal handler. Jobs
+        are killed by :meth:`run`.
+        """
+        self.stopping = True
+        if kill:
+            self.killing = True
+
+    def _claim(self):
+        free = self.runner.limit - len(self.runner)
+        if self.stopping or free <= 0:
+            return 0
+        jobs = models.Job.claim(models.Job.STATUS_PREPARED, free, analysis=self.analysis,
+                                lease=self.lease)
+        for job in jobs:
+            folder = self._folder(job)
+            if self.kind == 'bsub':
+                # The job stays claimed until LSF reports its ID
+                command, = caf_submit.submit_many([folder], self.runner, self.kind,
+                                                  timeout=BSUB_TIMEOUT,
+                                                  on_exit=self._submitted, lsf=self.lsf)
+                self.jobs[command] = job
+                continue
+            if not job.transition(models.Job.STATUS_SUBMITED, keep=True):
+                continue
+            command, = caf_submit.submit_many([folder], self.runner, self.kind,
+                                              timeout=self.timeout, on_exit=self._ended,
+                                              job_rss=self._job_rss(job.Analysis))
+            self.jobs[command] = job
+            print("Submitted %s for run %d" % (job.Analysis, job.Run.RunNumber))
+        return len(jobs)
+
+    def _job_rss(self, analysis):
+        if self.job_rss is not None:
+            return self.job_rss
+        if analysis not in self.peak_rss:
+            self.peak_rss[analysis] = (models.Job.peak_rss(analysis) or
+                                       caf_submit.DEFAULT_JOB_RSS * caf_submit.MIB)
+        return self.peak_rss[analysis]
+
+    def _folder(self, job):
+        return caf_db_prepare.job_folder(self.output, job.Analysis, job.Run.RunNumber)
+
+    def _renew(self):
+        for job in self.jobs.itervalues():
+            if not job.renew(self.lease):
+                print("Lost the claim of %s for run %d" % (job.Analysis, job.Run.RunNumber))
+
+    def _finish(self, job, ok, reason=None, usage=None):
+        status = models.Job.STATUS_DONE if ok else models.Job.STATUS_FAILED
+        if not job.transition(status, **(usage or {})):
+            print("Lost the claim of %s for run %d" % (job.Analysis, job.Run.RunNumber))
+            return
+        if ok:
+            self.done += 1
+        else:
+            self.failed += 1
+        print("%s for run %d %s" % (job.Analysis, job.Run.RunNumber,
+                                    "done" if ok else "failed, %s" % reason))
+
+    def _release(self, job):
+        if job.release():
+            print("%s for run %d returned to %s" % (job.Analysis, job.Run.RunNumber,
+                                                    models.Job.STATUS_PREPARED))
+        else:
+            print("Lost the claim of %s for run %d" % (job.Analysis, job.Run.RunNumber))
+
+    def _usage(self, job, command=None):
+        """ Job fields of resources used by the ended job """
+        usage = {'OutputSize': caf_submit.folder_size(self._folder(job))}
+        if command is None:
+            return usage
+        usage.update(ExitCode=command.returncode, WallTime=command.ended - command.started)
+        if command.usage is not None:
+            usage.update(UserTime=command.usage.ru_utime, SysTime=command.usage.ru_stime,
+                         # KiB on Linux
+                         MaxRSS=command.usage.ru_maxrss * 1024)
+        return usage
+
+    def _ended(self, command):
+        job = self.jobs.pop(command)
+        if command.cancelled:
+            self._release(job)
+        elif command.error is not None:
+            self._finish(job, False, "couldn't start: %s" % command.error,
+                         self._usage(job, command))
+        elif command.timed_out:
+            self._finish(job, False, "timed out", self._usage(job, command))
+        else:
+            self._finish(job, command.ok, "exit code %d" % command.returncode,
+                         self._usage(job, command))
+
+    def _submitted(self, command):
+        job = self.jobs.pop(command)
+        batch_id = self.lsf.job_id(command.stdout) if command.ok else None
+        if command.cancelled:
+            self._release(job)
+        elif batch_id is None:
+            reason = command.error or command.stderr.strip() or "no job ID"
+            self._finish(job, False, "bsub failed: %s" % reason)
+        elif job.transition(models.Job.STATUS_SUBMITED, BatchId=batch_id):
+            self.queued += 1
+            print("Submitted %s for run %d as LSF job %s" % (job.Analysis, job.Run.RunNumber,
+                                                             batch_id))
+        else:
+            print("Lost the claim of %s for run %d" % (job.Analysis, job.Run.RunNumber))
+
+    def _track(self):
+        """ Query statuses of jobs queued in the batch system by one `bjobs` """
+        if self.kind != 'bsub' or self.tracking is not None or self.stopping:
+            return
+        query = (models.Job
+                 .select(models.Job, models.Run)
+                 .join(models.Run)
+                 .where((models.Job.Status == models.Job.STATUS_SUBMITED) &
+                        ~(models.Job.BatchId >> None)))
+        if self.analysis is not None:
+            query = query.where(models.Job.Analysis == self.analysis)
+        jobs = list(query)
+        self.queued = len(jobs)
+        if jobs:
+            self.tracking = self.runner.submit(runner.Command(
+                self.lsf.bjobs_args([job.BatchId for job in jobs]), timeout=BSUB_TIMEOUT,
+                on_exit=lambda command: self._tracked(command, jobs)
+            ))
+
+    def _tracked(self, command, jobs):
+        """ Finish jobs ended in the batch system """
+        self.tracking = None
+        if command.cancelled or command.timed_out or command.error is not None:
+            return
+        statuses = self.lsf.parse_bjobs(command.stdout, command.stderr)
+        self.queued = 0
+        for job in jobs:
+            if job.BatchId not in statuses:
+                # Not reported, e.g. LSF is down, asked again in the next cycle
+                self.queued += 1
+            elif statuses[job.BatchId] is None:
+                # Forgotten by LSF after its clean period, the report tells the end
+                code = self.lsf.job_report(self._folder(job), job.BatchId)
+                if code is None:
+                    self._finish(job, False, "LSF job %s is not found" % job.BatchId)
+                else:
+                    usage = self._usage(job)
+                    usage['ExitCode'] = code
+                    self._finish(job, code == 0, "LSF job %s has exited with %d" % (
+                        job.BatchId, code), usage)
+            elif statuses[job.BatchId] in self.lsf.FINISHED:
+                ok = self.lsf.FINISHED[statuses[job.BatchId]]
+                usage = self._usage(job)
+                if ok:
+                    usage['ExitCode'] = 0
+                self._finish(job, ok, "LSF job %s has exited" % job.BatchId, usage)
+            else:
+                self.queued += 1
+
+    def run(self, follow=False, poll=DEFAULT_POLL):
+        """ Run jobs until none is prepared or queued, or until stopped if `follow`
+
+        Args:
+            follow (Optional[bool]): wait for jobs prepared meanwhile
+            poll (Optional[float]): seconds between checks for prepared jobs
+                and polls of the batch system
+
+        Returns:
+            (int, int): numbers of done and failed jobs
+        """
+        models.Job.release_stale()
+        renewed = checked = tracked = time.time()
+        self._track()
+        while True:
+            if self.killing:
+                self.killing = False
+                self.runner.cancel_all()
+            elif self.stopping and self.runner.queue:
+                # Claimed jobs that haven't started, e.g. waiting for memory,
+                # go back to PREPARED
+                for command in list(self.runner.queue):
+                    self.runner.cancel(command)
+            if not len(self.runner):
+                if self.stopping:
+                    break
+                checked = time.time()
+                if not self._claim():
+                    if not (follow or self.queued):
+                        break
+                    time.sleep(poll)
+            else:
+                ended = self.runner.poll(poll)
+                now = time.time()
+                if now - renewed > self.lease / 4:
+                    self._renew()
+                    models.Job.release_stale()
+                    renewed = now
+                # A job has freed its slot, or jobs may have been prepared meanwhile
+                if ended or now - checked > poll:
+                    checked = now
+                    self._claim()
+            if time.time() - tracked >= poll:
+                tracked = time.time()
+                self._track()
+        return self.done, self.failed
 
 
 def _main():
-    pass
+    cli = _get_cli()
+    models.connect(profile=cli.profile)
+    scheduler = Scheduler(
+        output=cli.output,
+        limit=cli.jobs,
+        kind=cli.type,
+        analysis=cli.analysis,
+        timeout=cli.timeout,
+        lease=cli.lease,
+        lsf=caf_submit.LsfBackend(queue=cli.queue, prefix=cli.lsf),
+        rss=cli.rss * caf_submit.MIB if cli.rss else None,
+        job_rss=cli.job_rss * caf_submit.MIB if cli.job_rss else None
+    )
+
+    def stop(signum, frame):
+        if not scheduler.stopping:
+            print("Waiting for running jobs, signal again to kill them")
+        scheduler.stop(kill=scheduler.stopping)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    done, failed = scheduler.run(follow=cli.follow, poll=cli.poll)
+    print("%d jobs done, %d failed" % (done, failed))
 
 if __name__ == '__main__':
     _main()
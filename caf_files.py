@@ -7,7 +7,9 @@ This tool can be executed as a standalone program or used as a library.
 .. code-block:: bash
 
     usage: caf_files.py [-h] [-l {ERROR,WARNING,INFO,DEBUG,VERBOSE}]
-                        [-p PATHS [PATHS ...]] -r RUN
+                        [-p PATHS [PATHS ...]] [-j JOBS] [-c CACHE] [-b]
+                        [--local] [--latency LATENCY] [-d]
+                        -r RUN [RUN ...]
 
     Find files in eos by their path
 
@@ -17,7 +19,16 @@ This tool can be executed as a standalone program or used as a library.
                             Logging level
       -p PATHS [PATHS ...], --paths PATHS [PATHS ...]
                             EOS paths
-      -r RUN, --run RUN     Run number
+      -j JOBS, --jobs JOBS  Maximum number of concurrent EOS listings
+      -c CACHE, --cache CACHE
+                            Cache directory listings in the SQLite file
+      -b, --bulk            One recursive listing per EOS path instead of
+                            listing every run directory
+      --local               Paths are local directories instead of EOS
+      --latency LATENCY     Synthetic latency of every local listing, s
+      -d, --details         Report size, mtime and adler32 checksum of files
+      -r RUN [RUN ...], --run RUN [RUN ...]
+                            Run numbers
 
 Default paths for searching raw files:
     /eos/atlas/atlastier0/rucio/data15_calib/calibration_L1CaloPmtScan
@@ -26,11 +37,35 @@ Default paths for searching raw files:
     /eos/atlas/atlastier0/rucio/data15_calib/calibration_L1CaloPprPedestalRunPars
     /eos/atlas/atlastier0/rucio/data15_calib/calibration_L1CaloPprPhos4ScanPars
 
+Directories are listed by a backend:
+
+* :class:`EosBackend` - `eos.select` CLI, needs AFS
+* :class:`LocalBackend` - local directory tree with the same layout, runs anywhere
+* :class:`FakeBackend` - local directory tree with a synthetic latency of every
+  listing, see `benchmarks/bench_listing.py`
+
 """
+import sys
 import argparse
 import subprocess
+import collections
 import json
 import os
+import zlib
+import time
+import sqlite3
+import threading
+import functools
+from multiprocessing.pool import ThreadPool
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+import runner
 
 DEAFULT_SOURCE = [
     "/eos/atlas/atlastier0/rucio/data15_calib/calibration_L1CaloPmtScan/",
@@ -42,6 +77,18 @@ DEAFULT_SOURCE = [
 
 EOS_CMD = '/afs/cern.ch/project/eos/installation/0.3.84-aquamarine/bin/eos.select'
 
+FileInfo = collections.namedtuple('FileInfo', ['name', 'size', 'mtime', 'checksum'])
+""" File path with its size in bytes, modification time in seconds and adler32 checksum """
+
+DEFAULT_JOBS = 8
+""" Default maximum number of concurrent EOS listings, keep it low not to
+overload the EOS MGM """
+
+POSITIVE_TTL = 3600
+""" Default time (in seconds) after which an existing run directory is listed again """
+NEGATIVE_TTL = 1800
+""" Default time (in seconds) after which a missing run directory is listed again """
+
 
 def _get_cli():
     parser = argparse.ArgumentParser(description='Find files in eos by their path')
@@ -49,41 +96,354 @@ def _get_cli():
                         choices=['ERROR', 'WARNING', 'INFO', 'DEBUG', 'VERBOSE'],
                         help="Logging level", default='ERROR')
     parser.add_argument('-p', '--paths', nargs='+', help="EOS paths", default=DEAFULT_SOURCE)
-    parser.add_argument('-r', '--run',  type=int, help="Run number", required=True)
+    parser.add_argument('-j', '--jobs', type=int, help="Maximum number of concurrent EOS listings",
+                        default=DEFAULT_JOBS)
+    parser.add_argument('-c', '--cache', help="Cache directory listings in the SQLite file")
+    parser.add_argument('-b', '--bulk', action='store_true',
+                        help="One recursive listing per EOS path instead of listing "
+                        "every run directory", default=False)
+    parser.add_argument('--local', action='store_true',
+                        help="Paths are local directories instead of EOS", default=False)
+    parser.add_argument('--latency', type=float,
+                        help="Synthetic latency of every local listing, s")
+    parser.add_argument('-d', '--details', action='store_true',
+                        help="Report size, mtime and adler32 checksum of files", default=False)
+    parser.add_argument('-r', '--run', type=int, nargs='+', help="Run numbers", required=True)
 
     return parser.parse_args()
 
 
-def get_files_by_path(run, eos_path):
+class Backend(object):
+    """ Interface of a storage listing backend """
+
+    def ls(self, path, quiet=False):
+        """ List directory
+
+        Args:
+            path (string): directory
+            quiet (Optional[bool]): don't report errors, the directory
+                is expected to be missing sometimes
+
+        Returns:
+            [string]: names in the directory
+
+        Raises:
+            OSError: the directory can't be listed
+        """
+        raise NotImplementedError
+
+    def find(self, path, details=False, skip=None):
+        """ List all files under the directory recursively
+
+        Args:
+            path (string): directory
+            details (Optional[bool]): report size, mtime and checksum too
+            skip (Optional[callable]): called with paths of subdirectories,
+                files under the ones it returns True for are left out
+
+        Returns:
+            iterator of file paths or :data:`FileInfo` with `details`
+
+        Raises:
+            OSError: the directory can't be listed
+        """
+        raise NotImplementedError
+
+
+class EosBackend(Backend):
+    """ EOS through the `eos.select` CLI
+
+    Args:
+        cmd (Optional[string]): eos executable, :data:`EOS_CMD` by default
+    """
+
+    def __init__(self, cmd=None):
+        self.cmd = cmd
+
+    def ls_args(self, path):
+        """ Command line of the directory listing """
+        return [self.cmd or EOS_CMD, 'ls', path]
+
+    def find_args(self, path, details=False):
+        """ Command line of the recursive listing """
+        args = [self.cmd or EOS_CMD, 'find', '-f']
+        if details:
+            args += ['--size', '--mtime', '--checksum']
+        return args + [path]
+
+    def ls(self, path, quiet=False):
+        try:
+            with open(os.devnull, 'w') as FNULL:
+                lines = subprocess.check_output(self.ls_args(path),
+                                                stderr=FNULL if quiet else None)
+        except subprocess.CalledProcessError as err:
+            raise OSError("eos ls %s exited with %d" % (path, err.returncode))
+        return [line for line in lines.split('\n') if line]
+
+    @staticmethod
+    def _parse(line):
+        """ Parse `path=... size=... mtime=... checksum=...` line of `eos find` """
+        fields = dict(token.split('=', 1) for token in line.split() if '=' in token)
+        return FileInfo(
+            fields['path'], int(fields['size']), float(fields['mtime']),
+            fields.get('checksum')
+        )
+
+    @staticmethod
+    def _skipped(path, name, skip):
+        """ A directory between `path` and the file `name` is skipped """
+        directory = os.path.join(path, '')
+        if not name.startswith(directory):
+            return False
+        for part in name[len(directory):].split('/')[:-1]:
+            directory = os.path.join(directory, part)
+            if skip(directory):
+                return True
+            directory = os.path.join(directory, '')
+        return False
+
+    def find(self, path, details=False, skip=None):
+        # The output is read line by line, so a listing of a whole scan root
+        # is never held in memory. `eos find` can't prune, skipped
+        # directories are filtered out of it
+        proc = subprocess.Popen(self.find_args(path, details), stdout=subprocess.PIPE)
+        try:
+            for line in iter(proc.stdout.readline, ''):
+                line = line.rstrip('\n')
+                if not line:
+                    continue
+                entry = self._parse(line) if details else line
+                if skip is None or not self._skipped(path, entry.name if details else entry,
+                                                     skip):
+                    yield entry
+        finally:
+            proc.stdout.close()
+            retcode = proc.wait()
+        if retcode:
+            raise OSError("eos find -f %s exited with %d" % (path, retcode))
+
+
+class LocalBackend(Backend):
+    """ Local directory tree with the same layout as EOS
+
+    Checksums are computed by reading the files, EOS keeps them in its namespace.
+    """
+
+    def ls(self, path, quiet=False):
+        if scandir is not None:
+            return sorted(entry.name for entry in scandir(path))
+        return sorted(os.listdir(path))
+
+    @staticmethod
+    def _info(path):
+        checksum = 1
+        with open(path, 'rb') as stream:
+            for chunk in iter(lambda: stream.read(1 << 20), b''):
+                checksum = zlib.adler32(chunk, checksum)
+        stat = os.stat(path)
+        return FileInfo(path, stat.st_size, stat.st_mtime, '%08x' % (checksum & 0xffffffff))
+
+    def find(self, path, details=False, skip=None):
+        if not os.path.isdir(path):
+            raise OSError("%s is not a directory" % path)
+        for dirpath, dirnames, filenames in os.walk(path):
+            if skip is not None:
+                dirnames[:] = [name for name in dirnames
+                               if not skip(os.path.join(dirpath, name))]
+            for name in filenames:
+                name = os.path.join(dirpath, name)
+                yield self._info(name) if details else name
+
+
+class FakeBackend(LocalBackend):
+    """ Local directory tree with a synthetic latency
+
+    Args:
+        latency (Optional[float]): seconds added to every listing, as
+            a spawn of `eos` and a round trip to the MGM
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+
+    def ls(self, path, quiet=False):
+        time.sleep(self.latency)
+        return LocalBackend.ls(self, path, quiet)
+
+    def find(self, path, details=False, skip=None):
+        time.sleep(self.latency)
+        return LocalBackend.find(self, path, details, skip)
+
+
+DEFAULT_BACKEND = EosBackend()
+""" Backend used when none is given """
+
+
+class ListingCache(object):
+    """ Persistent cache of EOS directory listings keyed by directory path
+
+    * a missing run directory is not listed again for `negative_ttl` seconds
+    * an existing run directory is listed again after `positive_ttl` seconds,
+      new datasets may show up in it
+    * a dataset directory is listed again after `positive_ttl` seconds until
+      two listings find the same files. The dataset is complete then and
+      its directory is never listed again
+
+    The cache can be shared by the listing threads.
+
+    Args:
+        path (string): SQLite file, created if it doesn't exist
+        positive_ttl (Optional[int]): seconds
+        negative_ttl (Optional[int]): seconds
+    """
+    def __init__(self, path, positive_ttl=POSITIVE_TTL, negative_ttl=NEGATIVE_TTL):
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # Losing the last listings on a crash only costs listing them again
+        self.db.execute('PRAGMA synchronous = OFF')
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS listings (
+                path TEXT PRIMARY KEY,
+                names TEXT,
+                listed REAL NOT NULL,
+                final INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+
+    def _entry(self, path):
+        row = self.db.execute(
+            'SELECT names, listed, final FROM listings WHERE path = ?', (path,)
+        ).fetchone()
+        if row is None:
+            return None
+        names, listed, final = row
+        return (None if names is None else json.loads(names)), listed, final
+
+    def get(self, path):
+        """ Get cached listing
+
+        Returns:
+            (bool, [string]): True if the listing is still valid and the names,
+            names are None for a missing directory
+        """
+        with self.lock:
+            entry = self._entry(path)
+        if entry is None:
+            return False, None
+        names, listed, final = entry
+        ttl = self.negative_ttl if names is None else self.positive_ttl
+        return bool(final or time.time() < listed + ttl), names
+
+    def put(self, path, names, dataset=False):
+        """ Store listing
+
+        Args:
+            path (string): directory
+            names ([string]): names in the directory, None if it is missing
+            dataset (Optional[bool]): it is a dataset directory, that becomes
+                final when its listing doesn't change
+        """
+        with self.lock:
+            entry = self._entry(path)
+            final = dataset and names and entry is not None and entry[0] == names
+            self.db.execute(
+                'INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?)',
+                (path, None if names is None else json.dumps(names), time.time(), int(bool(final)))
+            )
+            self.db.commit()
+
+    def invalidate(self, prefix=''):
+        """ Drop cached listings of the paths starting with the prefix, all by default """
+        with self.lock:
+            self.db.execute(
+                'DELETE FROM listings WHERE substr(path, 1, ?) = ?', (len(prefix), prefix)
+            )
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+def _ls(path, missing_ok=False, cache=None, backend=None):
+    """ List EOS directory
+
+    Args:
+        path (string): directory
+        missing_ok (bool): return an empty list if the directory can't be listed.
+            Such directories are run directories, others are dataset directories
+        cache (Optional[ListingCache]): listing cache
+        backend (Optional[Backend]): listing backend, :data:`DEFAULT_BACKEND` by default
+
+    Returns:
+        [string]: names in the directory
+    """
+    if cache is not None:
+        valid, names = cache.get(path)
+        if valid:
+            return names if names is not None else []
+    try:
+        names = (backend or DEFAULT_BACKEND).ls(path, quiet=missing_ok)
+    except OSError:
+        if not missing_ok:
+            raise
+        if cache is not None:
+            cache.put(path, None)
+        return []
+    if cache is not None:
+        cache.put(path, names, dataset=not missing_ok)
+    return names
+
+
+def _ls_files(path, cache=None, backend=None):
+    """ List files of a dataset directory with their size, mtime and checksum
+
+    Args:
+        path (string): directory
+        cache (Optional[ListingCache]): listing cache
+        backend (Optional[Backend]): listing backend, :data:`DEFAULT_BACKEND` by default
+
+    Returns:
+        [FileInfo]: files ordered by name
+    """
+    if cache is not None:
+        valid, entries = cache.get(path)
+        # Listings cached without details are listed again
+        if valid and entries is not None and all(isinstance(e, list) for e in entries):
+            return [FileInfo(*entry) for entry in entries]
+    infos = sorted((backend or DEFAULT_BACKEND).find(path, details=True))
+    if cache is not None:
+        cache.put(path, [list(info) for info in infos], dataset=True)
+    return infos
+
+
+def get_files_by_path(run, eos_path, cache=None, backend=None, details=False):
     """ Find files by run number and EOS path
 
     Args:
         run (int): run number
         eos_path (string): eos path. e.g. /eos/atlas/atlastier0/rucio/data15_calib/calibration_L1CaloPprPhos4ScanPars/
+        cache (Optional[ListingCache]): listing cache
+        backend (Optional[Backend]): listing backend
+        details (Optional[bool]): return :data:`FileInfo` instead of paths
 
     Returns:
         [string]: List of files
     """
     result = []
-    lines = ""
     run_path = os.path.join(eos_path, "%08d" % run)
-    try:
-        FNULL = open(os.devnull, 'w')
-        lines = subprocess.check_output([EOS_CMD, 'ls', run_path], stderr=FNULL)
-    except subprocess.CalledProcessError:
-        pass
-
-    for line in lines.split('\n'):
-        if line:
-            raw_path = os.path.join(run_path, line)
-            files = subprocess.check_output([EOS_CMD, 'ls', raw_path])
-            for f in files.split('\n'):
-                if f:
-                    result.append(os.path.join(raw_path, f))
+    for line in _ls(run_path, missing_ok=True, cache=cache, backend=backend):
+        raw_path = os.path.join(run_path, line)
+        for f in _ls_files(raw_path, cache=cache, backend=backend):
+            result.append(f if details else f.name)
     return result
 
 
-def get_files(run, paths=None):
+def get_files(run, paths=None, cache=None, backend=None, details=False):
     """ Find files by run number and list of possible EOS paths
 
     Args:
@@ -94,6 +454,9 @@ def get_files(run, paths=None):
             /eos/atlas/atlastier0/rucio/data15_calib/calibration_L1CaloPprDacScanPars
             /eos/atlas/atlastier0/rucio/data15_calib/calibration_L1CaloPprPedestalRunPars
             /eos/atlas/atlastier0/rucio/data15_calib/calibration_L1CaloPprPhos4ScanPars
+        cache (Optional[ListingCache]): listing cache
+        backend (Optional[Backend]): listing backend
+        details (Optional[bool]): return :data:`FileInfo` instead of paths
 
     Returns:
         [string]: List of files
@@ -102,13 +465,207 @@ def get_files(run, paths=None):
     paths = paths if paths else DEAFULT_SOURCE
 
     for path in paths:
-        result += get_files_by_path(run, path)
+        result += get_files_by_path(run, path, cache, backend, details)
+    return result
+
+
+def index_files(paths=None, runs=None, backend=None, details=False, first_run=None):
+    """ Find files of many runs with one recursive listing per EOS path
+
+    Only `<path>/<run>/<dataset>/<file>` entries are taken. Files of every
+    run come in the same order as from :func:`get_files`. Run directories
+    below `first_run` aren't listed and only the kept runs are held in
+    memory. A path that can't be listed is reported and left out.
+
+    Args:
+        paths (Optional[string]): eos paths, see :func:`get_files`
+        runs (Optional[[int]]): run numbers to keep, all runs by default
+        backend (Optional[Backend]): listing backend
+        details (Optional[bool]): return :data:`FileInfo` instead of paths
+        first_run (Optional[int]): lowest run number to keep
+
+    Returns:
+        dict: run number -> list of files, only runs with files
+    """
+    paths = paths if paths else DEAFULT_SOURCE
+    runs = set(runs) if runs is not None else None
+
+    def keep(run):
+        return (runs is None or run in runs) and (first_run is None or run >= first_run)
+
+    result = {}
+    for path in paths:
+        prefix = os.path.join(path, '')
+
+        def skip(directory):
+            # Run directories, i.e. direct children of the path, of runs not kept
+            name = directory[len(prefix):]
+            return (directory.startswith(prefix) and '/' not in name and
+                    len(name) == 8 and name.isdigit() and not keep(int(name)))
+
+        found = {}
+        try:
+            for entry in (backend or DEFAULT_BACKEND).find(path, details, skip):
+                name = entry.name if details else entry
+                if not name.startswith(prefix):
+                    continue
+                parts = name[len(prefix):].split('/')
+                if len(parts) != 3 or len(parts[0]) != 8 or not parts[0].isdigit():
+                    continue
+                run = int(parts[0])
+                if keep(run):
+                    found.setdefault(run, []).append(entry)
+        except OSError as err:
+            # Files found before the failure may be incomplete
+            sys.stderr.write("Skipped %s, it can't be listed: %s\n" % (path, err))
+            continue
+        for run, files in found.iteritems():
+            result.setdefault(run, []).extend(sorted(files))
+    return result
+
+
+def get_files_many(runs, paths=None, jobs=DEFAULT_JOBS, cache=None, bulk=False,
+                   backend=None, details=False):
+    """ Find files of many runs, listing EOS directories concurrently
+
+    Run directories of all (run, path) combinations are listed in parallel,
+    then all their dataset directories. Files of every run come in the same
+    order as from :func:`get_files`.
+
+    Args:
+        runs ([int]): run numbers
+        paths (Optional[string]): eos paths, see :func:`get_files`
+        jobs (Optional[int]): maximum number of concurrent `eos ls`
+        cache (Optional[ListingCache]): listing cache
+        bulk (Optional[bool]): use :func:`index_files` instead, it is cheaper
+            when runs are many compared to the runs in the paths
+        backend (Optional[Backend]): listing backend
+        details (Optional[bool]): return :data:`FileInfo` instead of paths
+
+    Returns:
+        dict: run number -> list of files
+    """
+    paths = paths if paths else DEAFULT_SOURCE
+    if bulk:
+        index = index_files(paths, runs, backend, details, min(runs) if runs else None)
+        return dict((run, index.get(run, [])) for run in runs)
+    result = dict((run, []) for run in runs)
+    pool = ThreadPool(max(1, jobs))
+    try:
+        run_dirs = [
+            (run, os.path.join(path, "%08d" % run)) for run in runs for path in paths
+        ]
+        listings = pool.map(
+            lambda run_dir: _ls(run_dir, missing_ok=True, cache=cache, backend=backend),
+            [run_dir for _, run_dir in run_dirs]
+        )
+        raw_dirs = [
+            (run, os.path.join(run_dir, name))
+            for (run, run_dir), names in zip(run_dirs, listings) for name in names
+        ]
+        listings = pool.map(
+            lambda raw_path: _ls_files(raw_path, cache=cache, backend=backend),
+            [raw_path for _, raw_path in raw_dirs]
+        )
+    finally:
+        pool.close()
+        pool.join()
+    for (run, _), infos in zip(raw_dirs, listings):
+        result[run] += infos if details else [info.name for info in infos]
+    return result
+
+
+def get_files_async(runs, cmd_runner, paths=None, details=False, timeout=None,
+                    on_run=None):
+    """ Find files of many runs with `eos` commands driven by the runner
+
+    Only listings of the run directories are submitted here, listings of
+    datasets are submitted as soon as their run directory is listed. Nothing
+    runs until the caller drives the runner (e.g. :meth:`runner.Runner.run`),
+    so file discovery can share one loop with other commands. Files of every
+    run come in the same order as from :func:`get_files`.
+
+    Args:
+        runs ([int]): run numbers
+        cmd_runner (runner.Runner): its limit bounds the concurrent listings
+        paths (Optional[string]): eos paths, see :func:`get_files`
+        details (Optional[bool]): return :data:`FileInfo` instead of paths
+        timeout (Optional[float]): seconds for every listing
+        on_run (Optional[callable]): called as `on_run(run, files)` as soon as
+            all files of the run are known
+
+    Returns:
+        dict: run number -> list of files, filled in as runs are complete.
+        The runner raises OSError if a dataset can't be listed
+    """
+    paths = paths if paths else DEAFULT_SOURCE
+    eos = EosBackend()
+    result = {}
+    # run -> path index -> dataset name -> files
+    found = dict((run, [{} for _ in paths]) for run in runs)
+    pending = dict((run, len(paths)) for run in runs)
+
+    def done(run):
+        pending[run] -= 1
+        if pending[run]:
+            return
+        files = []
+        for datasets in found[run]:
+            for name in sorted(datasets):
+                files += datasets[name]
+        result[run] = files
+        if on_run is not None:
+            on_run(run, files)
+
+    def check(command):
+        if command.cancelled:
+            return False
+        if command.timed_out or (command.returncode and command.args[1] == 'find'):
+            raise OSError("%s failed: %s" % (' '.join(command.args), command.stderr.strip()))
+        return True
+
+    def dataset_listed(run, index, name, command):
+        if not check(command):
+            return
+        infos = sorted(eos._parse(line) for line in command.stdout.split('\n') if line)
+        found[run][index][name] = infos if details else [info.name for info in infos]
+        done(run)
+
+    def run_listed(run, index, run_path, command):
+        if not check(command):
+            return
+        # A run directory which can't be listed has no files yet
+        names = [line for line in command.stdout.split('\n') if line] if command.ok else []
+        pending[run] += len(names)
+        for name in names:
+            cmd_runner.submit(runner.Command(
+                eos.find_args(os.path.join(run_path, name), details=True), timeout=timeout,
+                on_exit=functools.partial(dataset_listed, run, index, name)
+            ))
+        done(run)
+
+    for run in runs:
+        for index, path in enumerate(paths):
+            run_path = os.path.join(path, "%08d" % run)
+            cmd_runner.submit(runner.Command(
+                eos.ls_args(run_path), timeout=timeout,
+                on_exit=functools.partial(run_listed, run, index, run_path)
+            ))
     return result
 
 
 def _main():
     cli = _get_cli()
-    result = get_files(cli.run, cli.paths)
+    cache = ListingCache(cli.cache) if cli.cache else None
+    backend = None
+    if cli.latency is not None:
+        backend = FakeBackend(cli.latency)
+    elif cli.local:
+        backend = LocalBackend()
+    result = get_files_many(cli.run, cli.paths, cli.jobs, cache, cli.bulk, backend,
+                            cli.details)
+    if len(cli.run) == 1:
+        result = result[cli.run[0]]
     print(json.dumps(result, indent=2))
 
 if __name__ == '__main__':
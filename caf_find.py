@@ -8,7 +8,9 @@ This tool can be executed as a standalone program or called as a function  `get_
 
     usage: caf_find.py [-h] [-l {ERROR,WARNING,INFO,DEBUG,VERBOSE}]
                        [--runtype RUNTYPE] [-p PARTITIONS [PARTITIONS ...]]
-                       [--recenabled RECENABLED] [--cleanstop CLEANSTOP] -r RUN
+                       [--recenabled RECENABLED] [--cleanstop CLEANSTOP]
+                       [--concurrent] [--fixture FIXTURE] [--latency LATENCY]
+                       [--cache CACHE] [--refresh] -r RUN
 
     Find runs by the certain creteria
 
@@ -23,6 +25,13 @@ This tool can be executed as a standalone program or called as a function  `get_
                             Recording enabled?
       --cleanstop CLEANSTOP
                             Clean stop
+      --concurrent          Browse EOR, EventCounters and Strategy folders
+                            concurrently
+      --fixture FIXTURE     Replay COOL from the JSON-lines fixture instead of
+                            connecting to COOL
+      --latency LATENCY     Synthetic latency of the fixture round trips, s
+      --cache CACHE         Cache payloads of ended runs in the SQLite file
+      --refresh             Drop the cached payloads before the search
       -r RUN, --run RUN     Run number to start from
 
 """
@@ -30,14 +39,14 @@ import logging
 import argparse
 import json
 import sys
+import time
+from multiprocessing.pool import ThreadPool
 
-try:
-    from PyCool import cool
-except ImportError:
-    sys.stderr.write("Please run asetup before running the tool (any configuration)\n")
-    sys.exit(-1)
+import conditions
+import iov
 
-from CoolConvUtilities import AtlCoolLib
+DEFAULT_LOOKBACK = 2 * 24 * 3600
+""" Default look-back window (in seconds) for runs that are still open """
 
 # =============================================================================
 # Setup logger
@@ -61,6 +70,15 @@ def _get_cli():
                         default=['TileL1CaloCombined'])
     parser.add_argument('--recenabled', type=bool, help="Recording enabled?", default=True)
     parser.add_argument('--cleanstop', type=bool, help="Clean stop", default=True)
+    parser.add_argument('--concurrent', action='store_true',
+                        help="Browse EOR, EventCounters and Strategy folders concurrently")
+    parser.add_argument('--fixture',
+                        help="Replay COOL from the JSON-lines fixture instead of connecting to COOL")
+    parser.add_argument('--latency', type=float,
+                        help="Synthetic latency of the fixture round trips, s", default=0.0)
+    parser.add_argument('--cache', help="Cache payloads of ended runs in the SQLite file")
+    parser.add_argument('--refresh', action='store_true',
+                        help="Drop the cached payloads before the search")
     parser.add_argument('-r', "--run", type=int, help="Run number to start from",
                         default=266000, required=True)
 
@@ -68,12 +86,70 @@ def _get_cli():
 # =============================================================================
 
 
-def _payload_to_dict(payload):
-    result = {}
-    for p in payload:
-        result[p] = payload[p]
-    return result
-# =============================================================================
+_LOOKUPS = {
+    'exact': lambda value, arg: value == arg,
+    'ne': lambda value, arg: value != arg,
+    'gt': lambda value, arg: value > arg,
+    'gte': lambda value, arg: value >= arg,
+    'lt': lambda value, arg: value < arg,
+    'lte': lambda value, arg: value <= arg,
+    'in': lambda value, arg: value in arg,
+    'range': lambda value, arg: arg[0] <= value <= arg[1],
+}
+
+
+class _Predicate(object):
+    """ Selection criteria compiled into a predicate over run payloads
+
+    Criteria are parsed once: `__in` values become frozensets, `__range`
+    values become (low, high) tuples and every lookup is resolved to its
+    test function.
+
+    Supported lookups: `exact` (default), `ne`, `gt`, `gte`, `lt`, `lte`,
+    `in` and `range` (inclusive). A criterion without a value (None), or an
+    exact one with a false value, only requires the name in the payload.
+
+    Args:
+        selection (dict): criteria, e.g. {'RecordedEvents__gte': 1700}
+
+    Raises:
+        ValueError: unknown lookup
+    """
+    def __init__(self, selection):
+        self.terms = []
+        for name, value in sorted(selection.iteritems()):
+            key, _, lookup = name.partition('__')
+            lookup = lookup or 'exact'
+            if lookup not in _LOOKUPS:
+                raise ValueError("Unknown lookup '{0}' in '{1}'".format(lookup, name))
+            if value is None or (lookup == 'exact' and not value):
+                # Not given, or falsy as the former filter ignored: the name must exist
+                self.terms.append((key, None, None))
+                continue
+            if lookup == 'in':
+                value = frozenset(value)
+            elif lookup == 'range':
+                value = tuple(value)
+            self.terms.append((key, _LOOKUPS[lookup], value))
+
+    def __call__(self, payload):
+        for key, test, value in self.terms:
+            if key not in payload:
+                return False
+            if test and not test(payload[key], value):
+                return False
+        return True
+
+    def partial(self, payload):
+        """ Check only the criteria on the names the payload has
+
+        Used on SOR payloads, the rest is checked when EOR and EventCounters
+        are merged in.
+        """
+        for key, test, value in self.terms:
+            if key in payload and test and not test(payload[key], value):
+                return False
+        return True
 
 
 class _Selector(object):
@@ -81,176 +157,481 @@ class _Selector(object):
     cooltlbpath = '/TRIGGER/LUMI'
     cooll1calopath = '/TRIGGER/L1Calo/V1/Conditions'
     coolstrategypath = '/TRIGGER/Receivers/Conditions'
-
-    def __init__(self, cool_tdaq, cool_trig, oracle=False):
+    sorfolder = coolpath + '/SOR'
+    eorfolder = coolpath + '/EOR'
+    countersfolder = coolpath + '/EventCounters'
+    strategyfolder = coolstrategypath + '/Strategy'
+
+    def __init__(self, cool_tdaq, cool_trig, oracle=False, concurrent=False, backend=None,
+                 cache=None):
+        self.backend = backend or conditions.CoolBackend(oracle)
+        self.cache = cache
+        self.concurrent = concurrent
+        self.oracle = oracle
+        self.dbnames = {'tdaq': cool_tdaq, 'trig': cool_trig}
+        self.timings = {}
         self.filter = {}
+        self.predicate = _Predicate({})
+        self.selections = {}
+        self.matched = {}
+        self.accepted = {}
+        self.seen = []
+        self.open = set()
         try:
-            self.cool_tdaq = AtlCoolLib.indirectOpen(
-                cool_tdaq, True, oracle, debug=False
-            )
-            self.cool_trig = AtlCoolLib.indirectOpen(
-                cool_trig, True, oracle, debug=False
-            )
+            self.cool_tdaq = self.backend.open(cool_tdaq)
+            self.cool_trig = self.backend.open(cool_trig)
         except Exception:
             logger.exception("Could not open cool database")
             return
         logger.info("Connected to {0}".format(cool_tdaq))
+        self.dbs = {'tdaq': self.cool_tdaq, 'trig': self.cool_trig}
 
-        self.mintime = cool.ValidityKeyMin
-        self.maxtime = cool.ValidityKeyMax
-
-    def _filter_by_sor(self, payload):
-        res = True
-        if "RunType" in self.filter:
-            res = payload["RunType"] == self.filter["RunType"]
-        if "RecordingEnabled" in self.filter:
-            res &= (
-                self.filter["RecordingEnabled"] == payload["RecordingEnabled"]
-            )
-        return res
-
-    def _filter(self, payload):
-        for name, value in self.filter.iteritems():
-            special_index = name.find('__')
-            if special_index > 0:
-                payload_name = name[:special_index]
-            else:
-                payload_name = name
-            if payload_name not in payload:
-                return False
-
-            if value:
-                if name.endswith('__gt'):
-                    if payload[payload_name] < value:
-                        return False
-                    continue
-
-                if name.endswith('__in'):
-                    if payload[payload_name] not in value:
-                        return False
-                    continue
-
-                if payload[payload_name] != value:
-                    return False
-
-        return True
+        self.mintime = conditions.VALIDITY_KEY_MIN
+        self.maxtime = conditions.VALIDITY_KEY_MAX
 
     def set_selection(self, **argw):
+        """ Set selection criteria
+
+        Criteria are given as `<payload name>[__<lookup>]=<value>`, see
+        :class:`_Predicate` for the lookups. A criterion with an empty value
+        (None, False, 0, ...) only requires the payload to have the name.
+        """
         self.filter = argw
+        self.predicate = _Predicate(argw)
+        self.selections = {}
+
+    def add_selection(self, name, run1=0, **argw):
+        """ Add a named selection
+
+        With named selections runs_by_range keeps the runs that pass any of
+        them, :meth:`split` fans the runs out by selection.
+
+        Args:
+            name (string): selection name, e.g. listener name
+            run1 (Optional[int]): first run of the selection
+            argw: selection criteria, the same as for :meth:`set_selection`
+        """
+        self.selections[name] = (run1, _Predicate(argw))
+
+    def _match_sor(self, run, payload):
+        if not self.selections:
+            return self.predicate.partial(payload)
+        names = [
+            name for name, (first, predicate) in self.selections.iteritems()
+            if run >= first and predicate.partial(payload)
+        ]
+        self.matched[run] = names
+        return bool(names)
+
+    def _match(self, run, payload):
+        if not self.selections:
+            return self.predicate(payload)
+        names = [
+            name for name in self.matched[run]
+            if self.selections[name][1](payload)
+        ]
+        self.accepted[run] = names
+        return bool(names)
+
+    def split(self, runlist):
+        """ Fan out runs found by runs_by_range to the named selections
+
+        Returns:
+            dict: selection name -> list of run records ordered by run number
+        """
+        result = dict((name, []) for name in self.selections)
+        for run in sorted(runlist.iterkeys()):
+            for name in self.accepted.get(run, []):
+                result[name].append(runlist[run])
+        return result
+
+    def scan_of(self, name):
+        """ Runs seen by the last runs_by_range call for the named selection
+
+        Returns:
+            dict: `seen` and `open` runs, see :func:`get_runs`
+        """
+        first = self.selections[name][0]
+        return {
+            'seen': [(run, sortime) for run, sortime in self.seen if run >= first],
+            'open': set(run for run in self.open if name in self.matched[run])
+        }
+
+    def _browse(self, db, folder, since, until, channels=None, connect=False):
+        """ Browse the folder and return its objects as list of :data:`conditions.IOV`
+
+        With `connect` the browse opens its own connection to `db`
+        """
+        start = time.time()
+        if connect:
+            handle = self.backend.open(self.dbnames[db])
+        else:
+            handle = self.dbs[db]
+        result = list(self.backend.browse(handle, folder, since, until, channels))
+        self.timings[folder] = time.time() - start
+        logger.info("Browsed {0}: {1} objects in {2:.3f} s".format(
+            folder, len(result), self.timings[folder]))
+        return result
+
+    def _browse_all(self, browses):
+        if not self.concurrent:
+            return [self._browse(*browse) for browse in browses]
+        pool = ThreadPool(len(browses))
+        try:
+            # map keeps the order of the browses, so merging is deterministic
+            return pool.map(lambda browse: self._browse(*browse, connect=True), browses)
+        finally:
+            pool.close()
+            pool.join()
 
     def runs_by_range(self, run1=0, run2=(1 << 31) - 1):
         """Query /TDAQ/RunCtrl/LB_Params to get details of runs in runrange
         Use both SOR_Params and EOR_Params to catch runs which ended badly.
-        Return a map of runs to RunParams objects"""
+        Return a map of runs to RunParams objects
+
+        Only the SOR pass determines the run range. In concurrent mode the
+        EOR, EventCounters and Strategy folders are then browsed in parallel.
+        Browse time of every folder is kept in `timings`.
+
+        With a cache only the runs it doesn't hold completely are browsed"""
         # get detector status information if needed
 
         runlist = {}
+        self.matched = {}
+        self.accepted = {}
+        self.seen = []
+        self.open = set()
+        self.timings = {}
+        start = time.time()
+        if self.cache is not None:
+            return self._cached_runs_by_range(run1, run2)
 
         # =====================================================================
         # SOR
         # =====================================================================
-        nsor = 0
-        # nsor_filtered = 0
-
-        folder_sor = self.cool_tdaq.getFolder(_Selector.coolpath + '/SOR')
-
-        itr = folder_sor.browseObjects(
-            (run1 << 32),
-            (run2 << 32),
-            cool.ChannelSelection.all()
-        )
+        for obj in self._browse('tdaq', self.sorfolder, run1 << 32, run2 << 32):
+            run = obj.payload['RunNumber']
+            self.seen.append((run, obj.payload['SORTime']))
+            if self._match_sor(run, obj.payload):
+                runlist[run] = obj.payload
 
-        while itr.goToNext():
-            nsor += 1
-            payload = itr.currentRef().payload()
-            run = payload['RunNumber']
-            if self._filter_by_sor(payload):
-                runlist[run] = _payload_to_dict(payload)
-
-        itr.close()
         if not runlist:
             return runlist
         # =====================================================================
-        # EOR
+        # EOR, EventCounters and (in concurrent mode) Strategy
         # =====================================================================
-        # now query EOR and fill in missing info
-        neor = 0
-        # neor_filtered = 0
-        folder_eor = self.cool_tdaq.getFolder(_Selector.coolpath + '/EOR')
-        itr = folder_eor.browseObjects(
-            min(runlist.keys()) << 32,
-            max(runlist.keys()) << 32,
-            cool.ChannelSelection.all()
-        )
-        while itr.goToNext():
-            payload = itr.currentRef().payload()
-            run = payload['RunNumber']
-            if run in runlist:
-                runlist[run].update(_payload_to_dict(payload))
-                neor += 1
-
-        # logging.info("EOR has data for %i runs" % neor)
-        itr.close()
+        first, last = min(runlist.iterkeys()) << 32, max(runlist.iterkeys()) << 32
+        browses = [
+            ('tdaq', self.eorfolder, first, last),
+            ('tdaq', self.countersfolder, first, last),
+        ]
+        if self.concurrent:
+            # The selection is not known yet, take strategies for all SOR runs
+            browses.append(self._gains_browse(runlist))
+        results = self._browse_all(browses)
+        eor, counters = results[:2]
         # =====================================================================
-        # EventCounters
-        # =====================================================================
-        # nevc = 0
-        # nevc_filtered = 0
-
-        folder_counters = self.cool_tdaq.getFolder(
-            _Selector.coolpath + '/EventCounters')
-        itr = folder_counters.browseObjects(
-            min(runlist.keys()) << 32,
-            max(runlist.keys()) << 32,
-            cool.ChannelSelection.all()
-        )
+        # now fill in missing info from EOR
+        for obj in eor:
+            run = obj.payload['RunNumber']
+            if run in runlist:
+                runlist[run].update(obj.payload)
 
-        while itr.goToNext():
-            obj = itr.currentRef()
-            payload = obj.payload()
-            run = obj.since() >> 32
+        ended = set()
+        for obj in counters:
+            run = obj.since >> 32
             if run in runlist:
-                runlist[run].update(_payload_to_dict(payload))
-        itr.close()
+                runlist[run].update(obj.payload)
+                ended.add(run)
 
-        # =====================================================================
-        # Gain strategy
-        # =====================================================================
-        gain_list = list()
-        folder_gains = self.cool_trig.getFolder(
-            '{}/Strategy'.format(self.coolstrategypath)
+        self.open = set(
+            run for run, payload in runlist.iteritems()
+            if 'EORTime' not in payload or run not in ended
         )
-        itr = folder_gains.browseObjects(self.mintime, self.maxtime,
-                                         cool.ChannelSelection(0, 1))
-        current = -1
-        while itr.goToNext():
-            obj = itr.currentRef()
-            if obj.since() != current:
-                gain_list.append(
-                    {
-                        'since': obj.since(),
-                        'until': obj.until(),
-                        'payload': obj.payload()['name']
-                    }
-                )
-                current = obj.since()
-        # logging.info("Gain list %s" % str(gain_list))
+
         # =====================================================================
         # logging.info("Runs before selection:  %i" % len(runlist))
         for run in list(runlist.iterkeys()):
-            if not self._filter(runlist[run]):
+            if not self._match(run, runlist[run]):
                 del runlist[run]
-            else:
-                for gain in sorted(gain_list):
-                    if gain['since'] <= runlist[run]['SORTime'] <= gain['until']:
-                        runlist[run]['GainStrategy'] = gain['payload']
+        if not runlist:
+            return runlist
+        # =====================================================================
+        # Gain strategy
+        # =====================================================================
+        if self.concurrent:
+            gains = results[2]
+        else:
+            # Only the strategies valid during the selected runs are needed
+            gains = self._browse(*self._gains_browse(runlist))
+        # logging.info("Gain list %s" % str(gain_list))
+        index = iov.IntervalIndex(_gain_list(gains))
+        for payload in runlist.itervalues():
+            gain = index.find(payload['SORTime'])
+            if gain is not None:
+                payload['GainStrategy'] = gain
 
         # logging.info("Runs after selection:  %i" % len(runlist))
         # =====================================================================
+        logger.info("Runs found in {0:.3f} s, slowest folder {1}".format(
+            time.time() - start, max(self.timings, key=self.timings.get)))
         return runlist
 
+    def _gains_browse(self, runlist):
+        sortimes = [payload['SORTime'] for payload in runlist.itervalues()]
+        return ('trig', self.strategyfolder, min(sortimes), max(sortimes), (0, 1))
+
+    def _select(self, run, folders):
+        """ Apply the selection to a run given its payloads by folder
+
+        Returns:
+            dict: merged record of the run or None if the run is not selected
+        """
+        sor = folders[self.sorfolder]
+        self.seen.append((run, sor['SORTime']))
+        if not self._match_sor(run, sor):
+            return None
+        payload = {}
+        for folder in (self.sorfolder, self.eorfolder, self.countersfolder):
+            payload.update(folders.get(folder, {}))
+        if not self._ended(folders):
+            self.open.add(run)
+        if not self._match(run, payload):
+            return None
+        payload.update(folders.get(self.strategyfolder, {}))
+        return payload
+
+    def _ended(self, folders):
+        """ A run is complete, and can be cached, once both its EOR and
+        EventCounters records are written """
+        return self.eorfolder in folders and self.countersfolder in folders
+
+    def _records(self, run1, run2):
+        """ Payloads of all runs in the range by folder, to fill the cache """
+        records = {}
+        for obj in self._browse('tdaq', self.sorfolder, run1 << 32, run2 << 32):
+            records[obj.payload['RunNumber']] = {self.sorfolder: obj.payload}
+        if not records:
+            return records
+        first, last = min(records.iterkeys()) << 32, max(records.iterkeys()) << 32
+        eor, counters, gains = self._browse_all([
+            ('tdaq', self.eorfolder, first, last),
+            ('tdaq', self.countersfolder, first, last),
+            self._gains_browse(dict(
+                (run, folders[self.sorfolder]) for run, folders in records.iteritems()
+            ))
+        ])
+        for obj in eor:
+            run = obj.payload['RunNumber']
+            if run in records:
+                records[run].setdefault(self.eorfolder, {}).update(obj.payload)
+        for obj in counters:
+            run = obj.since >> 32
+            if run in records:
+                records[run].setdefault(self.countersfolder, {}).update(obj.payload)
+        index = iov.IntervalIndex(_gain_list(gains))
+        for folders in records.itervalues():
+            gain = index.find(folders[self.sorfolder]['SORTime'])
+            if gain is not None:
+                folders[self.strategyfolder] = {'GainStrategy': gain}
+        return records
+
+    def _cached_range(self, run1, run2):
+        """ Cached part of the range
+
+        Returns:
+            (dict, int): cached payloads by run and folder, first run to browse
+        """
+        coverage = self.cache.coverage()
+        if coverage and coverage[0] <= run1 <= coverage[1]:
+            return self.cache.load(run1, min(run2, coverage[1])), coverage[1] + 1
+        return {}, run1
+
+    def _cached_runs_by_range(self, run1, run2):
+        records, first = self._cached_range(run1, run2)
+        logger.info("{0} runs from cache, browsing from run {1}".format(len(records), first))
+        if first <= run2:
+            fresh = self._records(first, run2)
+            # Ended runs are cached, the cache is complete up to the first open run
+            last = first - 1
+            for run in sorted(fresh.iterkeys()):
+                if not self._ended(fresh[run]):
+                    break
+                last = run
+            for run, folders in fresh.iteritems():
+                if self._ended(folders):
+                    self.cache.put(run, folders)
+            self.cache.extend(first, last)
+            self.cache.commit()
+            records.update(fresh)
+
+        runlist = {}
+        for run in sorted(records.iterkeys()):
+            payload = self._select(run, records[run])
+            if payload is not None:
+                runlist[run] = payload
+        return runlist
+
+    def _stream(self, db, folder, since, until, channels=None):
+        return self.backend.browse(
+            self.backend.open(self.dbnames[db]), folder, since, until, channels
+        )
+
+    def iter_runs(self, run1=0, run2=(1 << 31) - 1):
+        """ Generator version of runs_by_range
+
+        SOR, EOR, EventCounters and Strategy folders are read as parallel
+        streams (each with its own connection) and merged run by run, so every
+        run is yielded as soon as its records are complete, in run number
+        order. Memory use doesn't grow with the run range. `seen`, `open` and
+        `accepted` are complete once the generator is exhausted.
+
+        Yields:
+            dict: record of a selected run
+        """
+        self.matched = {}
+        self.accepted = {}
+        self.seen = []
+        self.open = set()
+        first = run1
+        if self.cache is not None:
+            records, first = self._cached_range(run1, run2)
+            for run in sorted(records.iterkeys()):
+                payload = self._select(run, records[run])
+                if payload is not None:
+                    yield payload
+        if first > run2:
+            return
+        for payload in self._stream_runs(first, run2):
+            yield payload
+
+    def _stream_runs(self, run1, run2):
+        caching = self.cache is not None
+        eor = counters = gains = None
+        # With a cache all runs are read, the cache is complete up to the
+        # first open run
+        last, complete = run1 - 1, True
+
+        for obj in self.backend.browse(self.dbs['tdaq'], self.sorfolder,
+                                       run1 << 32, run2 << 32):
+            sor = obj.payload
+            run = sor['RunNumber']
+            if not caching and not self._match_sor(run, sor):
+                self.seen.append((run, sor['SORTime']))
+                continue
+            # Streams start at the first run that is needed
+            if eor is None:
+                eor = _Cursor(
+                    self._stream('tdaq', self.eorfolder, run << 32, run2 << 32),
+                    lambda obj: obj.payload['RunNumber']
+                )
+                counters = _Cursor(
+                    self._stream('tdaq', self.countersfolder, run << 32, run2 << 32),
+                    lambda obj: obj.since >> 32
+                )
+                gains = iov.IntervalCursor(_gain_list(self._stream(
+                    'trig', self.strategyfolder, sor['SORTime'], self.maxtime, (0, 1)
+                )))
+            folders = {self.sorfolder: sor}
+            for folder, cursor in ((self.eorfolder, eor), (self.countersfolder, counters)):
+                payload = cursor.pop(run)
+                if payload:
+                    folders[folder] = payload
+            if caching:
+                self._gain(gains, folders)
+                if self._ended(folders):
+                    self.cache.put(run, folders)
+                    if complete:
+                        last = run
+                else:
+                    complete = False
+            payload = self._select(run, folders)
+            if payload is None:
+                continue
+            if not caching:
+                self._gain(gains, folders)
+                payload.update(folders.get(self.strategyfolder, {}))
+            yield payload
+
+        if caching:
+            self.cache.extend(run1, last)
+            self.cache.commit()
+
+    def _gain(self, gains, folders):
+        gain = gains.find(folders[self.sorfolder]['SORTime'])
+        if gain is not None:
+            folders[self.strategyfolder] = {'GainStrategy': gain}
+
+
+def _gain_list(gains):
+    """ (since, until, name) of the strategies, channels with the same since
+    carry the same strategy """
+    current = -1
+    for obj in gains:
+        if obj.since != current:
+            yield (obj.since, obj.until, obj.payload['name'])
+            current = obj.since
+
+
+class _Cursor(object):
+    """ Forward-only cursor over a stream of IOVs ordered by run """
+    def __init__(self, objects, key):
+        self.objects = objects
+        self.key = key
+        self.current = next(self.objects, None)
+
+    def pop(self, run):
+        """ Skip the objects of earlier runs and merge the payloads of the run """
+        result = {}
+        while self.current is not None and self.key(self.current) <= run:
+            if self.key(self.current) == run:
+                result.update(self.current.payload)
+            self.current = next(self.objects, None)
+        return result
+
+
+def high_water_mark(seen, pending, lookback=DEFAULT_LOOKBACK):
+    """ Find the last fully processed run of a scan
+
+    A run is fully processed when neither it nor any earlier run seen by the
+    scan is pending. Pending runs (still open, files not yet available, ...)
+    hold the mark back only while they are within `lookback` seconds of the
+    newest run seen, so a run that never gets closed can't stall the mark
+    forever.
 
-def get_runs(run, loglevel, runtype, partitions, recenabled, cleanstop, minevents):
+    Args:
+        seen ([(int, int)]): (RunNumber, SORTime) of every run seen by the scan
+        pending (set): run numbers that should be looked at again next time
+        lookback (Optional[int]): look-back window in seconds
+
+    Returns:
+        (int, int): RunNumber and SORTime of the last fully processed run or
+        None if there is no such run
+    """
+    if not seen:
+        return None
+    seen = sorted(seen)
+    horizon = seen[-1][1] - lookback * 1000000000
+    mark = None
+    for run, sortime in seen:
+        if run in pending and sortime >= horizon:
+            break
+        mark = (run, sortime)
+    return mark
+
+
+def _selection(runtype, partitions, recenabled, cleanstop, minevents):
+    return dict(
+        RunType=runtype,
+        PartitionName__in=partitions,
+        RecordingEnabled=recenabled,
+        CleanStop=cleanstop,
+        RecordedEvents__gte=minevents
+    )
+
+
+def get_runs(run, loglevel, runtype, partitions, recenabled, cleanstop, minevents,
+             scan=None, concurrent=False, backend=None, cache=None):
     """ Find calibration runs by the specified conditions
 
     Args:
@@ -260,7 +641,15 @@ def get_runs(run, loglevel, runtype, partitions, recenabled, cleanstop, minevent
         partitions ([string]): L1CaloCombined, LArgL1CaloCombined,...
         recenabled (bool): Recording enabled?
         cleanstop (bool): It was clean stop?
-        minevents (int): Find runs with number of events more then minevents
+        minevents (int): Find runs with at least minevents events
+        scan (Optional[dict]): if given, it is filled with the `seen` runs
+            ([(RunNumber, SORTime)]) and the `open` runs (set of run numbers
+            without EOR record yet) of the scan. See :func:`high_water_mark`
+        concurrent (Optional[bool]): browse EOR, EventCounters and Strategy
+            folders concurrently
+        backend (Optional[conditions.Backend]): conditions database backend,
+            :class:`conditions.CoolBackend` by default
+        cache (Optional[conditions.RunCache]): cache of payloads of ended runs
 
     Returns:
         [dict]: List of records with information  about the run:
@@ -294,29 +683,146 @@ def get_runs(run, loglevel, runtype, partitions, recenabled, cleanstop, minevent
     # =========================================================================
     # Setup runs selector
     # =========================================================================
-    # TODO(sasha): convert to the function with one call to runs_by_range
-    selector = _Selector("COOLONL_TDAQ/CONDBR2", "COOLONL_TRIGGER/CONDBR2")
-    selector.set_selection(
-        RunType=runtype,
-        PartitionName__in=partitions,
-        RecordingEnabled=recenabled,
-        CleanStop=cleanstop,
-        RecordedEvents__gt=minevents
-    )
+    selector = _Selector("COOLONL_TDAQ/CONDBR2", "COOLONL_TRIGGER/CONDBR2",
+                         concurrent=concurrent, backend=backend, cache=cache)
+    selector.set_selection(**_selection(
+        runtype, partitions, recenabled, cleanstop, minevents
+    ))
     # =========================================================================
     runs = selector.runs_by_range(run1=run)
+    if scan is not None:
+        scan['seen'] = selector.seen
+        scan['open'] = selector.open
     result = []
     for key in sorted(runs.iterkeys()):
         result.append(runs[key])
     return result
 
 
+def iter_runs(run, loglevel, runtype, partitions, recenabled, cleanstop, minevents,
+              scan=None, backend=None, cache=None):
+    """ Generator version of :func:`get_runs`
+
+    Yields fully enriched run records in run number order as soon as each of
+    them is complete, so the caller can process the first runs while the
+    rest of the range is still being read from COOL.
+
+    Args:
+        The same as for :func:`get_runs`, `scan` is filled when the generator
+        is exhausted
+
+    Yields:
+        dict: record of a run, see :func:`get_runs`
+    """
+    logger.setLevel(getattr(logging, loglevel))
+    selector = _Selector("COOLONL_TDAQ/CONDBR2", "COOLONL_TRIGGER/CONDBR2",
+                         backend=backend, cache=cache)
+    selector.set_selection(**_selection(
+        runtype, partitions, recenabled, cleanstop, minevents
+    ))
+    for record in selector.iter_runs(run1=run):
+        yield record
+    if scan is not None:
+        scan['seen'] = selector.seen
+        scan['open'] = selector.open
+
+
+def _scans_selector(scans, runs, **argw):
+    runs = runs or {}
+    selector = _Selector("COOLONL_TDAQ/CONDBR2", "COOLONL_TRIGGER/CONDBR2", **argw)
+    for lst in scans:
+        selector.add_selection(
+            lst['name'],
+            run1=runs.get(lst['name'], lst['initialrun']),
+            **_selection(
+                runtype=lst['runtype'],
+                partitions=lst['daqpartitions'],
+                recenabled=lst.get('reconly', True),
+                cleanstop=lst.get('cleanstop', True),
+                minevents=lst.get('minevents', 0)
+            )
+        )
+    return selector, min(first for first, _ in selector.selections.itervalues())
+
+
+def get_runs_by_scans(scans, loglevel, runs=None, scan=None, concurrent=False,
+                      backend=None, cache=None):
+    """ Find calibration runs for several listeners with one pass over COOL
+
+    Opens the COOL connections once and browses every folder once over the
+    union of the listeners' run ranges, then fans the runs out to every
+    listener whose criteria they match.
+
+    Args:
+        scans ([dict]): search parameters of the listeners, see :mod:`settings`
+        loglevel (string): ERROR,WARNING,INFO,DEBUG,VERBOSE
+        runs (Optional[dict]): listener name -> run number to start from,
+            `initialrun` of the listener by default
+        scan (Optional[dict]): if given, it is filled with listener name ->
+            `seen` and `open` runs, see :func:`get_runs`
+        concurrent (Optional[bool]): browse EOR, EventCounters and Strategy
+            folders concurrently
+        backend (Optional[conditions.Backend]): conditions database backend,
+            :class:`conditions.CoolBackend` by default
+        cache (Optional[conditions.RunCache]): cache of payloads of ended runs
+
+    Returns:
+        dict: listener name -> list of records, see :func:`get_runs`
+    """
+    logger.setLevel(getattr(logging, loglevel))
+    if not scans:
+        return {}
+    selector, first = _scans_selector(
+        scans, runs, concurrent=concurrent, backend=backend, cache=cache
+    )
+    runlist = selector.runs_by_range(run1=first)
+    if scan is not None:
+        for lst in scans:
+            scan[lst['name']] = selector.scan_of(lst['name'])
+    return selector.split(runlist)
+
+
+def iter_runs_by_scans(scans, loglevel, runs=None, scan=None, backend=None, cache=None):
+    """ Generator version of :func:`get_runs_by_scans`
+
+    Args:
+        The same as for :func:`get_runs_by_scans`, `scan` is filled when the
+        generator is exhausted
+
+    Yields:
+        (dict, [string]): record of a run and names of the listeners it matches,
+        in run number order
+    """
+    logger.setLevel(getattr(logging, loglevel))
+    if not scans:
+        return
+    selector, first = _scans_selector(scans, runs, backend=backend, cache=cache)
+    for record in selector.iter_runs(run1=first):
+        yield record, selector.accepted[record['RunNumber']]
+    if scan is not None:
+        for lst in scans:
+            scan[lst['name']] = selector.scan_of(lst['name'])
+
+
 def _main():
     # Get command line parameters
     cli = _get_cli()
-    runs = get_runs(run=cli.run, loglevel=cli.log, runtype=cli.runtype, partitions=cli.partitions,
-                    recenabled=cli.recenabled, cleanstop=cli.cleanstop, minevents=0
-                    )
+    try:
+        backend = None
+        if cli.fixture:
+            backend = conditions.LocalBackend(cli.fixture, latency=cli.latency)
+        cache = None
+        if cli.cache:
+            cache = conditions.RunCache(cli.cache)
+            if cli.refresh:
+                cache.invalidate()
+        runs = get_runs(run=cli.run, loglevel=cli.log, runtype=cli.runtype,
+                        partitions=cli.partitions, recenabled=cli.recenabled,
+                        cleanstop=cli.cleanstop, minevents=0,
+                        concurrent=cli.concurrent, backend=backend, cache=cache)
+    except ImportError as e:
+        sys.stderr.write("%s\n" % e)
+        sys.exit(-1)
     # =========================================================================
     print(json.dumps(runs, indent=2))
 
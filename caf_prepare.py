@@ -90,13 +90,15 @@ def prepare(jo, files, output, asetup=None, postexec=None):
             content = content.replace('{{FILES}}', ', '.join(files))
             content = content.replace('{{ASETUP}}', asetup)
             # -----------------------------------------------------------------
-            if postexec_content:
-                content = content.replace('{{POSTEXEC}}', postexec_content)
+            content = content.replace('{{POSTEXEC}}', postexec_content or '')
         # ---------------------------------------------------------------------
         if content:
             output_name = "jobo.py" if i == 0 else os.path.basename(tmpl)
             with open(os.path.join(output, output_name), 'w') as f:
                 f.write(content)
+            if i > 0:
+                # The launcher is run directly by caf_submit
+                os.chmod(os.path.join(output, output_name), 0755)
     # -------------------------------------------------------------------------
 # ======================================================================
 
@@ -1,14 +1,15 @@
 #!/usr/bin/env python
 """
-Submit a job from the specified folder.
+Submit jobs from the specified folders.
 
 This tool can be executed as a standalone program or used as a library.
 
 .. code-block:: bash
 
     usage: caf_submit.py [-h] [-l {ERROR,WARNING,INFO,DEBUG,VERBOSE}]
-                         [-t {local,bsub}]
-                         folder
+                         [-t {local,bsub}] [-e ECHO] [-q QUEUE] [--lsf LSF]
+                         [-j SLOTS] [--rss RSS] [--job-rss JOB_RSS]
+                         folder [folder ...]
 
     Submit job
 
@@ -21,12 +22,42 @@ This tool can be executed as a standalone program or used as a library.
                             Logging level
       -t {local,bsub}, --type {local,bsub}
                             Submit engine
+      -e ECHO, --echo ECHO  Seconds between lines of the output echoed to the
+                            console, 0 echoes all output
+      -q QUEUE, --queue QUEUE
+                            LSF queue
+      --lsf LSF             Command prepended to bsub and bjobs, e.g. "python
+                            fake_lsf.py" to run without LSF
+      -j SLOTS, --slots SLOTS
+                            CPU slots of local jobs, a job takes one
+      --rss RSS             Memory budget of running local jobs, MiB
+      --job-rss JOB_RSS     Expected peak memory of a local job, MiB
+
+The output of a job goes to `log.out` and `log.err` in its folder.
+
+Local jobs run at once while CPU slots and memory are free, the rest wait
+(see :func:`run_local`).
 
 """
 
 import os
-import subprocess
+import re
+import sys
+import time
+import shlex
 import argparse
+import subprocess
+import multiprocessing
+
+import runner
+
+LOG_BUFFER = 1 << 20
+""" Buffer size of job log files, bytes """
+DEFAULT_QUEUE = '8nh'
+""" Default LSF queue """
+DEFAULT_JOB_RSS = 2048
+""" Default expected peak memory of a local job, MiB """
+MIB = 1 << 20
 
 
 def _get_cli():
@@ -36,7 +67,18 @@ def _get_cli():
                         help="Logging level", default='ERROR')
     parser.add_argument(
         '-t', '--type', help="Submit engine", choices=['local', 'bsub'], default='local')
-    parser.add_argument('folder', help="Folder with the launcher.sh")
+    parser.add_argument('-e', '--echo', type=float,
+                        help="Seconds between lines of the output echoed to the console, "
+                        "0 echoes all output", default=1.0)
+    parser.add_argument('-q', '--queue', help="LSF queue", default=DEFAULT_QUEUE)
+    parser.add_argument('--lsf', help="Command prepended to bsub and bjobs, "
+                        "e.g. \"python fake_lsf.py\" to run without LSF")
+    parser.add_argument('-j', '--slots', type=int, help="CPU slots of local jobs, a job takes one",
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--rss', type=int, help="Memory budget of running local jobs, MiB")
+    parser.add_argument('--job-rss', type=int, help="Expected peak memory of a local job, MiB",
+                        default=DEFAULT_JOB_RSS)
+    parser.add_argument('folder', nargs='+', help="Folder with the launcher.sh")
 
     return parser.parse_args()
 
@@ -45,36 +87,312 @@ def _get_launcher(folder):
     return os.path.join(folder, 'launcher.sh')
 
 
-def submit(folder, kind):
+class LsfBackend(object):
+    """ LSF batch system through the `bsub` and `bjobs` CLI
+
+    Args:
+        queue (Optional[string]): queue, :data:`DEFAULT_QUEUE` by default
+        prefix (Optional[string]): command prepended to `bsub` and `bjobs`,
+            e.g. `python fake_lsf.py` to run without LSF
+    """
+    FINISHED = {'DONE': True, 'EXIT': False}
+    """ Status of ended jobs -> the job has succeeded """
+
+    def __init__(self, queue=None, prefix=None):
+        self.queue = queue or DEFAULT_QUEUE
+        self.prefix = shlex.split(prefix) if prefix else []
+
+    def bsub_args(self, folder):
+        """ Command line submitting the launcher of the folder """
+        name = '_'.join(os.path.normpath(folder).split(os.sep)[-2:])
+        return self.prefix + [
+            'bsub', '-q', self.queue, '-J', name, '-cwd', folder,
+            '-o', os.path.join(folder, 'log.out'), '-e', os.path.join(folder, 'log.err'),
+            _get_launcher(folder)
+        ]
+
+    @staticmethod
+    def job_id(output):
+        """ Job ID from `Job <ID> is submitted to queue <QUEUE>.`, None if missing """
+        match = re.search(r'Job <(\d+)> is submitted', output)
+        return match.group(1) if match else None
+
+    @staticmethod
+    def job_report(folder, job_id):
+        """ Exit code from the report LSF appends to `log.out` of the job
+
+        `bjobs` forgets finished jobs after the CLEAN_PERIOD of LSF, their
+        report in the `-o` file tells how they have ended. The file may hold
+        reports of former jobs of the folder, only the one of `job_id` is used.
+
+        Args:
+            folder (string): job folder
+            job_id (string): LSF job ID
+
+        Returns:
+            int: exit code, negative signal number if killed, None if the
+            report isn't there
+        """
+        header = re.compile(r'^Subject: Job %s:' % re.escape(job_id))
+        found = False
+        try:
+            with open(os.path.join(folder, 'log.out'), 'r') as log:
+                for line in log:
+                    if not found:
+                        found = bool(header.match(line))
+                    elif line.startswith('Successfully completed.'):
+                        return 0
+                    elif line.startswith('Exited with'):
+                        match = re.match(r'Exited with exit code (\d+)', line)
+                        if match:
+                            return int(match.group(1))
+                        match = re.match(r'Exited with signal termination: (\d+)', line)
+                        return -int(match.group(1)) if match else 1
+                    elif line.startswith('Subject: Job '):
+                        # Report of another job without a status line
+                        found = bool(header.match(line))
+        except IOError:
+            pass
+        return None
+
+    def bjobs_args(self, ids):
+        """ Command line of the status query of the jobs """
+        return self.prefix + ['bjobs', '-a', '-w'] + list(ids)
+
+    @staticmethod
+    def parse_bjobs(out, err):
+        """ Parse output of `bjobs -a -w`
+
+        Returns:
+            dict: job ID -> status, e.g. PEND, RUN, DONE or EXIT, None for
+            jobs unknown to LSF. Jobs missing in the output for another
+            reason, e.g. LSF is down, are left out
+        """
+        statuses = dict((job_id, None) for job_id in re.findall(r'Job <(\d+)> is not found', err))
+        for line in out.splitlines():
+            fields = line.split()
+            if len(fields) > 2 and fields[0].isdigit():
+                statuses[fields[0]] = fields[2]
+        return statuses
+
+    def bjobs(self, ids):
+        """ Statuses of the jobs, queried with one `bjobs` call
+
+        Args:
+            ids ([string]): job IDs
+
+        Returns:
+            dict: see :meth:`parse_bjobs`
+        """
+        if not ids:
+            return {}
+        proc = subprocess.Popen(self.bjobs_args(ids), stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        return self.parse_bjobs(*proc.communicate())
+
+
+def folder_size(folder):
+    """ Total size of files in the folder and its subfolders, bytes """
+    size = 0
+    for root, _, names in os.walk(folder):
+        for name in names:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                # Removed meanwhile
+                pass
+    return size
+
+
+def submit(folder, kind, echo=None, lsf=None):
     """ Submit job from the specified folder
     Folder should contains launcher.sh script that do the main jon
 
     Args:
         folder (string): Folder with launcher.sh script
         kind (string): Name of the job processing backend. Can be `local`
-        (for example run at lxplus) or `bsub` batch system (not implemented yet)
+        (for example run at lxplus) or `bsub` batch system
+        echo (Optional[float]): console echo of the output, see :class:`LogPump`
+        lsf (Optional[LsfBackend]): LSF backend of `bsub` jobs
+
+    Raises:
+        ValueError: unknown submit engine
     """
     folder_abs = os.path.abspath(folder)
-    os.chdir(folder_abs)
     if kind == 'local':
-        _local(folder_abs)
+        run_local([folder_abs], slots=1, echo=echo)
+    elif kind == 'bsub':
+        _bsub(folder_abs, lsf or LsfBackend())
+    else:
+        raise ValueError("Unknown submit engine %s" % kind)
+
+
+def _bsub(folder, lsf):
+    output = subprocess.check_output(lsf.bsub_args(folder))
+    job_id = lsf.job_id(output)
+    if job_id is None:
+        raise OSError("bsub didn't report the job ID: %s" % output.strip())
+    print("Submitted %s as LSF job %s" % (folder, job_id))
+    return job_id
+
+
+def run_local(folders, slots=None, rss=None, job_rss=0, echo=None, timeout=None):
+    """ Run jobs of the folders on this machine and wait for them
+
+    Each launcher runs in its own folder. Jobs run at once while they fit
+    into the CPU slots and the memory budget, the rest is queued.
+
+    Args:
+        folders ([string]): folders with launcher.sh script
+        slots (Optional[int]): CPU slots, a job takes one. Number of CPUs by default
+        rss (Optional[int]): memory budget of running jobs, bytes, unlimited by default
+        job_rss (Optional[int]): expected peak memory of a job, bytes. Running
+            jobs are accounted with their measured memory if it's larger
+        echo (Optional[float]): console echo of the output, see :class:`LogPump`
+        timeout (Optional[float]): seconds, a job running longer is killed
+
+    Returns:
+        [runner.Command]: ended commands of the jobs
+    """
+    cmd_runner = runner.Runner(slots or multiprocessing.cpu_count(), rss)
+    commands = submit_many(folders, cmd_runner, timeout=timeout, echo=echo, job_rss=job_rss)
+    before = os.times()
+    cmd_runner.run()
+    after = os.times()
+    # CPU of this process only, the launchers run in children
+    sys.stderr.write("Ran %d jobs, %d failed. Log pump: %d bytes, %.3f s CPU in %.3f s\n" % (
+        len(commands), sum(not command.ok for command in commands),
+        sum(command.output_bytes for command in commands),
+        max(0.0, after[0] + after[1] - before[0] - before[1]), after[4] - before[4]))
+    return commands
+
+
+class LogPump(object):
+    """ Writes output of jobs to `log.out` and `log.err` in their folders
+
+    Use :meth:`output` and :meth:`close` as `on_output` and `on_exit` of
+    :class:`runner.Command`. Chunks read by the runner are written as they
+    are through buffered files, the output is never split into lines.
+
+    Args:
+        echo (Optional[float]): copy output to `stream`, everything if 0, or
+            at most the last line once in `echo` seconds. Nothing by default
+        stream (Optional[file]): console stream
+        buffering (Optional[int]): buffer size of the log files, bytes
+    """
+    def __init__(self, echo=None, stream=None, buffering=LOG_BUFFER):
+        self.echo = echo
+        self.stream = stream or sys.stdout
+        self.buffering = buffering
+        # (command, stream name) -> log file
+        self.logs = {}
+        self.echoed = 0.0
+
+    def output(self, command, name, data):
+        log = self.logs.get((command, name))
+        if log is None:
+            log = self.logs[(command, name)] = open(
+                os.path.join(command.cwd, 'log.out' if name == 'stdout' else 'log.err'),
+                'wb', self.buffering
+            )
+        log.write(data)
+        if self.echo is None:
+            return
+        if not self.echo:
+            self.stream.write(data)
+            return
+        now = time.time()
+        if now - self.echoed >= self.echo:
+            lines = data.rstrip('\n').rsplit('\n', 1)
+            self.stream.write(lines[-1] + '\n')
+            self.echoed = now
+
+    @staticmethod
+    def reset(folder):
+        """ Truncate the logs of the folder
+
+        A job that runs again in its folder doesn't keep the logs of the
+        former run in a stream it writes nothing to. The files are opened
+        only by the first chunk, so queued jobs hold no descriptors.
+        """
+        for name in ('log.out', 'log.err'):
+            open(os.path.join(folder, name), 'wb').close()
+
+    def close(self, command):
+        for name in ('stdout', 'stderr'):
+            log = self.logs.pop((command, name), None)
+            if log is not None:
+                log.close()
+
+
+def submit_many(folders, cmd_runner, kind='local', timeout=None, on_exit=None, echo=None,
+                lsf=None, job_rss=0):
+    """ Submit jobs from many folders through the command runner
+
+    Launchers run in their folders and their output goes to `log.out` and
+    `log.err` there (see :class:`LogPump`). Nothing runs until the caller
+    drives the runner (e.g. :meth:`runner.Runner.run`), its limit bounds the
+    running jobs.
+
+    For `bsub` the commands are the submissions, a command ends once LSF
+    has queued the job, see :meth:`LsfBackend.job_id` of its `stdout`.
+
+    Args:
+        folders ([string]): folders with launcher.sh script
+        cmd_runner (runner.Runner): command runner
+        kind (Optional[string]): `local` or `bsub`
+        timeout (Optional[float]): seconds, a job running longer is killed
+        on_exit (Optional[callable]): called as `on_exit(command)` when a job has ended
+        echo (Optional[float]): console echo of the output, see :class:`LogPump`
+        lsf (Optional[LsfBackend]): LSF backend of `bsub` jobs
+        job_rss (Optional[int]): expected peak memory of a local job, bytes,
+            see :class:`runner.Runner`
+
+    Returns:
+        [runner.Command]: commands of the jobs
+
+    Raises:
+        ValueError: unknown submit engine
+    """
+    if kind == 'bsub':
+        lsf = lsf or LsfBackend()
+        return [cmd_runner.submit(runner.Command(
+            lsf.bsub_args(os.path.abspath(folder)), timeout=timeout, on_exit=on_exit
+        )) for folder in folders]
+    if kind != 'local':
+        raise ValueError("Unknown submit engine %s" % kind)
+    pump = LogPump(echo)
 
+    def ended(command):
+        pump.close(command)
+        if on_exit is not None:
+            on_exit(command)
 
-def _local(folder):
-    p = subprocess.Popen([_get_launcher(folder)], stdout=subprocess.PIPE)
-    with open(os.path.join(folder, 'log.out'), 'w') as log:
-        while p.poll() is None:
-            l = p.stdout.readline()  # This blocks until it receives a newline.
-            print l,
-            log.write(l)
-        last = p.stdout.read()
-        print last
-        log.write(last)
+    commands = []
+    for folder in folders:
+        folder_abs = os.path.abspath(folder)
+        pump.reset(folder_abs)
+        commands.append(cmd_runner.submit(runner.Command(
+            [_get_launcher(folder_abs)], timeout=timeout, cwd=folder_abs,
+            on_output=pump.output, on_exit=ended, group=True, rss=job_rss
+        )))
+    return commands
 
 
 def _main():
     cli = _get_cli()
-    submit(folder=cli.folder, kind=cli.type)
+    if cli.type == 'local':
+        run_local(
+            folders=[os.path.abspath(folder) for folder in cli.folder],
+            slots=cli.slots,
+            rss=cli.rss * MIB if cli.rss else None,
+            job_rss=cli.job_rss * MIB,
+            echo=cli.echo
+        )
+        return
+    lsf = LsfBackend(queue=cli.queue, prefix=cli.lsf)
+    for folder in cli.folder:
+        submit(folder=folder, kind=cli.type, echo=cli.echo, lsf=lsf)
 
 if __name__ == '__main__':
     _main()
@@ -0,0 +1,282 @@
+"""
+Conditions database backends for :mod:`caf_find`
+
+* :class:`CoolBackend` - COOL database through PyCool/AtlCoolLib, needs `asetup`
+* :class:`LocalBackend` - replays IOVs from a JSON-lines fixture, runs anywhere
+
+:class:`RunCache` keeps payloads of ended runs between scans.
+
+Fixture for :class:`LocalBackend` has one IOV per line:
+
+.. code-block:: json
+
+    {"db": "COOLONL_TDAQ/CONDBR2", "folder": "/TDAQ/RunCtrl/SOR", "channel": 0,
+     "since": 1213213113548800, "until": 1213217408516096,
+     "payload": {"RunNumber": 282477, "RunType": "cismono", "...": "..."}}
+
+A fixture can be recorded from COOL with :func:`dump`.
+"""
+import bisect
+import collections
+import heapq
+import json
+import os
+import sqlite3
+import time
+
+VALIDITY_KEY_MIN = 0
+""" Same as cool.ValidityKeyMin """
+VALIDITY_KEY_MAX = (1 << 63) - 1
+""" Same as cool.ValidityKeyMax """
+
+IOV = collections.namedtuple('IOV', ['since', 'until', 'channel', 'payload'])
+""" Object of a conditions folder, payload is a dict """
+
+
+class Backend(object):
+    """ Interface of a conditions database backend """
+
+    def open(self, name):
+        """ Open database
+
+        Args:
+            name (string): database name, e.g. COOLONL_TDAQ/CONDBR2
+
+        Returns:
+            database handle for :meth:`browse`
+        """
+        raise NotImplementedError
+
+    def browse(self, db, folder, since, until, channels=None):
+        """ Browse objects of the folder which overlap [since, until]
+
+        Args:
+            db: database handle returned by :meth:`open`
+            folder (string): folder path, e.g. /TDAQ/RunCtrl/SOR
+            since (int): validity key
+            until (int): validity key
+            channels (Optional[(int, int)]): first and last channel,
+                all channels by default
+
+        Returns:
+            iterator of :data:`IOV` ordered by since
+        """
+        raise NotImplementedError
+
+
+class CoolBackend(Backend):
+    """ COOL database through PyCool/AtlCoolLib
+
+    Args:
+        oracle (Optional[bool]): connect to oracle instead of frontier
+
+    Raises:
+        ImportError: PyCool is not set up
+    """
+
+    def __init__(self, oracle=False):
+        try:
+            from PyCool import cool
+            from CoolConvUtilities import AtlCoolLib
+        except ImportError:
+            raise ImportError(
+                "Please run asetup before running the tool (any configuration)"
+            )
+        self.cool = cool
+        self.atlcoollib = AtlCoolLib
+        self.oracle = oracle
+
+    def open(self, name):
+        return self.atlcoollib.indirectOpen(name, True, self.oracle, debug=False)
+
+    def browse(self, db, folder, since, until, channels=None):
+        # COOL orders by channel first by default
+        order = self.cool.ChannelSelection.sinceBeforeChannel
+        if channels:
+            selection = self.cool.ChannelSelection(channels[0], channels[1], order)
+        else:
+            selection = self.cool.ChannelSelection(order)
+        itr = db.getFolder(folder).browseObjects(since, until, selection)
+        try:
+            while itr.goToNext():
+                obj = itr.currentRef()
+                payload = obj.payload()
+                yield IOV(
+                    obj.since(), obj.until(), obj.channelId(),
+                    dict((p, payload[p]) for p in payload)
+                )
+        finally:
+            itr.close()
+
+
+class LocalBackend(Backend):
+    """ Replays IOVs from a JSON-lines fixture
+
+    Args:
+        path (string): fixture path
+        latency (Optional[float]): synthetic latency in seconds added to every
+            :meth:`open` and :meth:`browse` call, as a round trip to the server
+    """
+
+    def __init__(self, path, latency=0.0):
+        self.latency = latency
+        # (db, folder) -> channel -> IOVs ordered by since
+        self.folders = collections.defaultdict(lambda: collections.defaultdict(list))
+        with open(path, 'r') as fixture:
+            for line in fixture:
+                if not line.strip():
+                    continue
+                obj = json.loads(line)
+                channel = obj.get('channel', 0)
+                self.folders[(obj['db'], obj['folder'])][channel].append(
+                    IOV(obj['since'], obj['until'], channel, obj['payload'])
+                )
+        self.since = {}
+        for key, channels in self.folders.iteritems():
+            for channel, objects in channels.iteritems():
+                objects.sort()
+                self.since[key + (channel,)] = [obj.since for obj in objects]
+
+    def open(self, name):
+        time.sleep(self.latency)
+        return name
+
+    def _browse_channel(self, db, folder, channel, since, until):
+        objects = self.folders[(db, folder)][channel]
+        # IOVs of a channel don't overlap, so only the one just before `since`
+        # can reach into the range
+        first = bisect.bisect_right(self.since[(db, folder, channel)], since) - 1
+        for obj in objects[max(first, 0):]:
+            if obj.since > until:
+                break
+            if obj.until > since:
+                yield IOV(obj.since, obj.until, obj.channel, dict(obj.payload))
+
+    def browse(self, db, folder, since, until, channels=None):
+        time.sleep(self.latency)
+        selected = [
+            channel for channel in sorted(self.folders.get((db, folder), {}))
+            if not channels or channels[0] <= channel <= channels[1]
+        ]
+        return heapq.merge(*[
+            self._browse_channel(db, folder, channel, since, until)
+            for channel in selected
+        ])
+
+
+def dump(backend, db, folder, since, until, stream, channels=None):
+    """ Record IOVs of the folder as JSON-lines fixture for :class:`LocalBackend`
+
+    Args:
+        backend (Backend): source backend, e.g. :class:`CoolBackend`
+        db (string): database name
+        folder (string): folder path
+        since (int): validity key
+        until (int): validity key
+        stream (file): output stream
+        channels (Optional[(int, int)]): first and last channel
+    """
+    handle = backend.open(db)
+    for obj in backend.browse(handle, folder, since, until, channels):
+        stream.write(json.dumps({
+            'db': db,
+            'folder': folder,
+            'channel': obj.channel,
+            'since': obj.since,
+            'until': obj.until,
+            'payload': obj.payload
+        }) + '\n')
+
+
+class RunCache(object):
+    """ Local store of COOL payloads of ended runs
+
+    Payloads of a run don't change once the run has ended, so they are kept
+    in a SQLite file keyed by run number and folder. The cache also keeps the
+    range of runs [first, last] it holds completely: a scan only has to browse
+    COOL for the runs outside of it.
+
+    Args:
+        path (string): SQLite file, created if it doesn't exist
+    """
+    def __init__(self, path):
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.db = sqlite3.connect(path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS payloads (
+                run INTEGER NOT NULL,
+                folder TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                PRIMARY KEY (run, folder)
+            );
+            CREATE TABLE IF NOT EXISTS coverage (
+                first INTEGER NOT NULL,
+                last INTEGER NOT NULL
+            );
+        """)
+
+    def coverage(self):
+        """ Range of runs the cache holds completely
+
+        Returns:
+            (int, int): first and last run or None if the cache is empty
+        """
+        return self.db.execute('SELECT first, last FROM coverage').fetchone()
+
+    def load(self, run1, run2):
+        """ Load cached payloads
+
+        Returns:
+            dict: run -> folder -> payload
+        """
+        result = {}
+        for run, folder, payload in self.db.execute(
+                'SELECT run, folder, payload FROM payloads WHERE run BETWEEN ? AND ?',
+                (run1, run2)):
+            result.setdefault(run, {})[folder] = json.loads(payload)
+        return result
+
+    def put(self, run, folders):
+        """ Store payloads of an ended run
+
+        Args:
+            run (int): run number
+            folders (dict): folder -> payload
+        """
+        self.db.executemany(
+            'INSERT OR REPLACE INTO payloads VALUES (?, ?, ?)',
+            [(run, folder, json.dumps(payload)) for folder, payload in folders.iteritems()]
+        )
+
+    def extend(self, first, last):
+        """ Mark runs [first, last] as completely cached
+
+        The range is merged with the current one if they overlap or touch,
+        otherwise it replaces it.
+        """
+        if last < first:
+            return
+        current = self.coverage()
+        if current and first <= current[1] + 1 and last >= current[0] - 1:
+            first, last = min(first, current[0]), max(last, current[1])
+        self.db.execute('DELETE FROM coverage')
+        self.db.execute('INSERT INTO coverage VALUES (?, ?)', (first, last))
+
+    def invalidate(self, run1=None, run2=None):
+        """ Drop cached payloads of the runs, all runs by default """
+        run1 = 0 if run1 is None else run1
+        run2 = (1 << 31) - 1 if run2 is None else run2
+        current = self.coverage()
+        self.db.execute('DELETE FROM payloads WHERE run BETWEEN ? AND ?', (run1, run2))
+        if current and run1 <= current[1] and run2 >= current[0]:
+            self.db.execute('DELETE FROM coverage')
+            self.extend(current[0], min(current[1], run1 - 1))
+        self.commit()
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
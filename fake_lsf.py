@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+"""
+Stand-in for the LSF `bsub` and `bjobs` commands, to run the `bsub` engine of
+:mod:`caf_submit` and :mod:`caf_db_submit` without LSF
+
+.. code-block:: bash
+
+    fake_lsf.py bsub [-q QUEUE] [-J NAME] [-cwd DIR] [-o OUT] [-e ERR] command...
+    fake_lsf.py bjobs [-a] [-w] [ID ...]
+
+    caf_db_submit.py -o OUTPUT -t bsub --lsf "python fake_lsf.py"
+
+Jobs really run on this machine, each one in a detached process, after a
+random queueing delay. Some of them fail without running. The output
+mimics LSF, so the same parsers are used: a job report is appended to the
+`-o` file and ended jobs are forgotten by `bjobs` after a clean period.
+
+The simulation is configured by environment variables:
+
+* `FAKE_LSF_DIR` - state directory, `<tmp>/fake_lsf_<user>` by default
+* `FAKE_LSF_DELAY` - maximum queueing delay, seconds, 2 by default
+* `FAKE_LSF_FAIL` - probability of a job to fail, 0.1 by default
+* `FAKE_LSF_REJECT` - probability of `bsub` to refuse a job, 0 by default
+* `FAKE_LSF_CLEAN` - seconds after which `bjobs` forgets an ended job, one
+  hour by default as CLEAN_PERIOD of LSF
+
+"""
+# ======================================================================
+import os
+import sys
+import json
+import time
+import fcntl
+import getpass
+import random
+import argparse
+import tempfile
+import subprocess
+# ======================================================================
+
+
+REPORT = """
+------------------------------------------------------------
+Sender: LSF System <lsfadmin@localhost>
+Subject: Job %(id)s: <%(name)s> in cluster <fake> %(end)s
+
+Job <%(name)s> was submitted from host <localhost>.
+Job was executed on host(s) <localhost>.
+<%(cwd)s> was used as the working directory.
+------------------------------------------------------------
+
+%(status)s
+"""
+""" Job report appended to the `-o` file, as LSF does """
+
+
+def _state_dir():
+    path = os.environ.get('FAKE_LSF_DIR') or os.path.join(
+        tempfile.gettempdir(), 'fake_lsf_%s' % getpass.getuser()
+    )
+    if not os.path.exists(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # Created by a concurrent bsub meanwhile
+            pass
+    return path
+
+
+def _next_id(state):
+    with open(os.path.join(state, 'last_id'), 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        job_id = int(f.read() or 0) + 1
+        f.seek(0)
+        f.truncate()
+        f.write(str(job_id))
+    return job_id
+
+
+def _job_dir(job_id):
+    return os.path.join(_state_dir(), str(job_id))
+
+
+def bsub(argv):
+    """ Queue the command, prints its job ID as LSF does """
+    parser = argparse.ArgumentParser(prog='bsub')
+    parser.add_argument('-q', dest='queue', default='normal')
+    parser.add_argument('-J', dest='name')
+    parser.add_argument('-cwd', dest='cwd', default=os.getcwd())
+    parser.add_argument('-o', dest='out')
+    parser.add_argument('-e', dest='err')
+    parser.add_argument('command', nargs=argparse.REMAINDER)
+    args = parser.parse_args(argv)
+    if not args.command:
+        sys.stderr.write("Job not submitted.\n")
+        return 255
+    if random.random() < float(os.environ.get('FAKE_LSF_REJECT', 0)):
+        sys.stderr.write("Request aborted by esub. Job not submitted.\n")
+        return 255
+
+    job_id = _next_id(_state_dir())
+    path = _job_dir(job_id)
+    os.mkdir(path)
+    submitted = time.time()
+    with open(os.path.join(path, 'job.json'), 'w') as f:
+        json.dump({
+            'queue': args.queue,
+            'name': args.name or os.path.basename(args.command[0]),
+            'cwd': args.cwd,
+            'out': args.out,
+            'err': args.err,
+            'command': args.command,
+            'submitted': submitted,
+            'start': submitted + random.uniform(0, float(os.environ.get('FAKE_LSF_DELAY', 2))),
+            'fail': random.random() < float(os.environ.get('FAKE_LSF_FAIL', 0.1)),
+        }, f)
+    with open(os.devnull, 'r+') as null:
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), '_run', str(job_id)],
+                         stdin=null, stdout=null, stderr=null, close_fds=True,
+                         preexec_fn=os.setsid)
+    print("Job <%d> is submitted to queue <%s>." % (job_id, args.queue))
+    return 0
+
+
+def _run(argv):
+    """ Body of a detached job process """
+    path = _job_dir(argv[0])
+    with open(os.path.join(path, 'job.json')) as f:
+        job = json.load(f)
+    time.sleep(max(0, job['start'] - time.time()))
+    open(os.path.join(path, 'started'), 'w').close()
+    code = 1
+    if not job['fail']:
+        with open(job['out'] or os.devnull, 'a') as out:
+            with open(job['err'] or os.devnull, 'a') as err:
+                try:
+                    code = subprocess.call(job['command'], cwd=job['cwd'], stdout=out,
+                                           stderr=err, close_fds=True)
+                except OSError as error:
+                    err.write("%s\n" % error)
+                    code = 127
+    if job['out']:
+        with open(job['out'], 'a') as out:
+            out.write(REPORT % {
+                'id': argv[0], 'name': job['name'], 'cwd': job['cwd'],
+                'end': 'Done' if code == 0 else 'Exited',
+                'status': ('Successfully completed.' if code == 0 else
+                           'Exited with exit code %d.' % code),
+            })
+    with open(os.path.join(path, 'exit.tmp'), 'w') as f:
+        f.write(str(code))
+    os.rename(os.path.join(path, 'exit.tmp'), os.path.join(path, 'exit'))
+    return 0
+
+
+def _status(path):
+    """ Status of the job, None once it's forgotten """
+    exit_path = os.path.join(path, 'exit')
+    if os.path.exists(exit_path):
+        clean = float(os.environ.get('FAKE_LSF_CLEAN', 3600))
+        if time.time() - os.path.getmtime(exit_path) > clean:
+            return None
+        with open(os.path.join(path, 'exit')) as f:
+            return 'DONE' if f.read() == '0' else 'EXIT'
+    if os.path.exists(os.path.join(path, 'started')):
+        return 'RUN'
+    return 'PEND'
+
+
+def bjobs(argv):
+    """ Print statuses of the jobs, all known jobs by default """
+    ids = [arg for arg in argv if not arg.startswith('-')]
+    state = _state_dir()
+    if not ids:
+        ids = sorted((name for name in os.listdir(state) if name.isdigit()), key=int)
+    rows, code = [], 0
+    for job_id in ids:
+        path = _job_dir(job_id)
+        status = _status(path) if os.path.exists(os.path.join(path, 'job.json')) else None
+        if status is None:
+            sys.stderr.write("Job <%s> is not found\n" % job_id)
+            code = 255
+            continue
+        with open(os.path.join(path, 'job.json')) as f:
+            job = json.load(f)
+        rows.append("%-8s %-8s %-6s %-10s %-12s %-12s %-30s %s" % (
+            job_id, getpass.getuser(), status, job['queue'], 'localhost',
+            'localhost', job['name'], time.strftime('%b %d %H:%M',
+                                                    time.localtime(job['submitted']))
+        ))
+    if rows:
+        print("%-8s %-8s %-6s %-10s %-12s %-12s %-30s %s" % (
+            'JOBID', 'USER', 'STAT', 'QUEUE', 'FROM_HOST', 'EXEC_HOST', 'JOB_NAME',
+            'SUBMIT_TIME'))
+        print('\n'.join(rows))
+    elif not argv or all(arg.startswith('-') for arg in argv):
+        sys.stderr.write("No job found\n")
+    return code
+
+
+def _main():
+    commands = {'bsub': bsub, 'bjobs': bjobs, '_run': _run}
+    if len(sys.argv) < 2 or sys.argv[1] not in commands:
+        sys.stderr.write("usage: fake_lsf.py {bsub,bjobs} ...\n")
+        return 2
+    return commands[sys.argv[1]](sys.argv[2:])
+
+if __name__ == '__main__':
+    sys.exit(_main())
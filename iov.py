@@ -0,0 +1,72 @@
+"""
+Helpers for COOL intervals of validity (IOVs)
+"""
+import bisect
+
+
+class IntervalIndex(object):
+    """ Sorted index of closed [since, until] intervals for point lookups
+
+    The index is built once and every lookup is a binary search, so looking
+    up `n` points in `m` intervals costs O((n + m) log m) instead of O(n * m).
+    Intervals are expected not to overlap, as the IOVs of one COOL channel.
+    If two intervals share a boundary, the later one wins.
+
+    Args:
+        intervals: iterable of (since, until, value) tuples
+    """
+    def __init__(self, intervals=()):
+        intervals = sorted(intervals, key=lambda interval: interval[:2])
+        self.since = [interval[0] for interval in intervals]
+        self.until = [interval[1] for interval in intervals]
+        self.values = [interval[2] for interval in intervals]
+
+    def __len__(self):
+        return len(self.since)
+
+    def find(self, point, default=None):
+        """ Find the value of the interval that contains the point
+
+        Args:
+            point (int): e.g. SORTime of a run
+            default: returned if no interval contains the point
+
+        Returns:
+            value of the interval
+        """
+        i = bisect.bisect_right(self.since, point) - 1
+        if i >= 0 and point <= self.until[i]:
+            return self.values[i]
+        return default
+
+
+class IntervalCursor(object):
+    """ Point lookups over closed [since, until] intervals streamed in since order
+
+    Points must be looked up in non-decreasing order. Every interval is read
+    once and only the current one is kept, so a lookup over a long stream of
+    intervals needs constant memory. Same matching rules as :class:`IntervalIndex`.
+
+    Args:
+        intervals: iterable of (since, until, value) tuples ordered by since
+    """
+    def __init__(self, intervals):
+        self.intervals = iter(intervals)
+        self.current = None
+        self.next = next(self.intervals, None)
+
+    def find(self, point, default=None):
+        """ Find the value of the interval that contains the point
+
+        Args:
+            point (int): not smaller than the previous point
+            default: returned if no interval contains the point
+
+        Returns:
+            value of the interval
+        """
+        while self.next is not None and self.next[0] <= point:
+            self.current, self.next = self.next, next(self.intervals, None)
+        if self.current is not None and point <= self.current[1]:
+            return self.current[2]
+        return default
@@ -1,12 +1,43 @@
 """ Database model
 """
 import os
+import uuid
+import socket
+import datetime
+import warnings
 from peewee import *
 from fields import *
 
 """ Default database is db/caf.db """
 db = SqliteDatabase('db/caf.db')
 
+SQLITE_MAX_VARIABLES = 999
+""" Maximum number of parameters of one SQLite statement """
+
+PROFILES = {
+    # SQLite defaults: rollback journal, fsync on every commit
+    'safe': [
+        ('journal_mode', 'delete'),
+        ('synchronous', 'FULL'),
+    ],
+    # Readers don't block the writer and the other way round, commits don't
+    # fsync (a power loss may lose the last transactions, never corrupts).
+    # WAL needs a local filesystem, not AFS or NFS
+    'performance': [
+        ('journal_mode', 'wal'),
+        ('synchronous', 'NORMAL'),
+        ('mmap_size', 256 * 1024 * 1024),
+        ('cache_size', -64 * 1024),  # KiB
+        ('busy_timeout', 30000),  # ms
+    ],
+}
+""" Pragmas applied to every connection, by profile name """
+DEFAULT_PROFILE = 'performance'
+""" Profile of the pragmas applied when no profile is given """
+DURABILITY_PRAGMAS = ('journal_mode', 'synchronous')
+""" Pragmas left as they are when no profile is given, the journal mode is
+stored in the database file and chosen by who created it """
+
 
 class BaseModel(Model):
     class Meta:
@@ -14,11 +45,11 @@ class BaseModel(Model):
 
 
 class Listener(BaseModel):
-    Name = CharField(max_length=255)
+    Name = CharField(max_length=255, unique=True)
 
 
 class Run(BaseModel):
-    RunNumber = IntegerField()
+    RunNumber = IntegerField(unique=True)
     EORTime = IntegerField()
     SORTime = IntegerField()
     RecordedEvents = IntegerField()
@@ -33,6 +64,22 @@ class Run(BaseModel):
 class File(BaseModel):
     Name = CharField(max_length=512)
     Run = ForeignKeyField(Run, related_name='Files')
+    # Reported by EOS at discovery, unknown for files found before
+    Size = BigIntegerField(null=True)
+    MTime = FloatField(null=True)
+    Checksum = CharField(max_length=8, null=True)
+
+    class Meta:
+        indexes = (
+            (('Run', 'Name'), True),
+        )
+
+
+class ScanMark(BaseModel):
+    """ High-water mark of the incremental run search of a listener """
+    Listener = ForeignKeyField(Listener, related_name='Marks', unique=True)
+    LastRun = IntegerField()
+    LastSORTime = IntegerField()
 
 
 # class RunListener(Model):
@@ -43,24 +90,398 @@ class File(BaseModel):
 #         database = db
 
 class Job(BaseModel):
+    """ Job of an analysis for a run
+
+    Workers claim jobs in a batch, :meth:`claim` moves them to a transient
+    status owned by the worker::
+
+        NEW -> PREPARING -> PREPARED -> SUBMITTING -> SUBMITED -> DONE
+                    |                       |                 -> FAILED
+                    +-> FAILED              +-> FAILED
+
+    A claim lasts for the lease the worker has set (see :meth:`claim` and
+    :meth:`renew`), an expired one is returned to the previous status by
+    :meth:`release_stale`, so jobs of a crashed worker are taken by others.
+    A job run by a local scheduler stays claimed while it runs (see `keep`
+    of :meth:`transition`), so it's submitted again if the scheduler dies.
+    A job queued in a batch system is not claimed, it has `BatchId` and any
+    scheduler polling the batch system finishes it.
+    """
     STATUS_NEW = "NEW"
+    STATUS_PREPARING = "PREPARING"
     STATUS_PREPARED = "PREPARED"
+    STATUS_SUBMITTING = "SUBMITTING"
     STATUS_SUBMITED = "SUBMITED"
     STATUS_FAILED = "FAILED"
     STATUS_DONE = "DONE"
 
+    CLAIMS = {
+        STATUS_NEW: STATUS_PREPARING,
+        STATUS_PREPARED: STATUS_SUBMITTING,
+    }
+    """ Status -> transient status of claimed jobs """
+    RELEASES = {
+        STATUS_PREPARING: STATUS_NEW,
+        STATUS_SUBMITTING: STATUS_PREPARED,
+        STATUS_SUBMITED: STATUS_PREPARED,
+    }
+    """ Status of a claimed job -> status it returns to when released """
+    TRANSITIONS = {
+        STATUS_NEW: (STATUS_PREPARING,),
+        STATUS_PREPARING: (STATUS_PREPARED, STATUS_FAILED, STATUS_NEW),
+        STATUS_PREPARED: (STATUS_SUBMITTING,),
+        STATUS_SUBMITTING: (STATUS_SUBMITED, STATUS_FAILED, STATUS_PREPARED),
+        STATUS_SUBMITED: (STATUS_DONE, STATUS_FAILED, STATUS_PREPARED),
+        STATUS_FAILED: (),
+        STATUS_DONE: (),
+    }
+    """ Status -> allowed next statuses """
+    TIMESTAMPS = {
+        STATUS_PREPARED: 'Prepared',
+        STATUS_SUBMITED: 'Submitted',
+        STATUS_DONE: 'Finished',
+        STATUS_FAILED: 'Finished',
+    }
+    """ Status -> field recording when the job got it """
+    LIVE_STATUSES = [
+        STATUS_NEW, STATUS_PREPARING, STATUS_PREPARED, STATUS_SUBMITTING, STATUS_SUBMITED,
+        STATUS_DONE
+    ]
+    """ All statuses but FAILED, a run with such a job doesn't need a new one """
+    LEASE = 3600
+    """ Default seconds a claim lasts unless renewed """
+
     Run = ForeignKeyField(Run, related_name='Jobs')
     Analysis = CharField(max_length=255)
     Start = DateTimeField()
-    Status = CharField(max_length=255)
+    Status = CharField(max_length=255, index=True)
+    Prepared = DateTimeField(null=True)
+    Submitted = DateTimeField(null=True)
+    Finished = DateTimeField(null=True)
+    # Claim token of the worker, the start and the end of its lease
+    Owner = CharField(max_length=255, null=True)
+    Claimed = DateTimeField(null=True)
+    Expires = DateTimeField(null=True)
+    # Job ID in the batch system, e.g. LSF
+    BatchId = CharField(max_length=64, null=True)
+    # Resources used by an ended job, unknown for jobs run elsewhere
+    ExitCode = IntegerField(null=True)
+    WallTime = FloatField(null=True)
+    UserTime = FloatField(null=True)
+    SysTime = FloatField(null=True)
+    MaxRSS = BigIntegerField(null=True)
+    OutputSize = BigIntegerField(null=True)
+
+    class Meta:
+        indexes = (
+            (('Run', 'Analysis', 'Status'), False),
+        )
+
+    @classmethod
+    def enqueue(cls, pairs):
+        """ Create NEW jobs unless the run has a live job of the analysis
+
+        Each check and insert is one statement, so concurrent workers
+        don't create duplicates.
+
+        Args:
+            pairs ([(Run, string)]): runs with analysis names
+
+        Returns:
+            int: number of created jobs
+        """
+        compiler = db.compiler()
+        table = compiler.quote(cls._meta.db_table)
+        run, analysis, start, status = [
+            compiler.quote(field.db_column)
+            for field in (cls.Run, cls.Analysis, cls.Start, cls.Status)
+        ]
+        sql = ('INSERT INTO {table} ({run}, {analysis}, {start}, {status}) '
+               'SELECT ?, ?, ?, ? WHERE NOT EXISTS ('
+               'SELECT 1 FROM {table} WHERE {run} = ? AND {analysis} = ? '
+               'AND {status} IN ({live}))').format(
+            table=table, run=run, analysis=analysis, start=start, status=status,
+            live=', '.join('?' * len(cls.LIVE_STATUSES)))
+        now = cls.Start.db_value(datetime.datetime.now())
+        created = 0
+        with db.atomic():
+            for db_run, name in pairs:
+                cursor = db.execute_sql(
+                    sql, [db_run.id, name, now, cls.STATUS_NEW, db_run.id, name] +
+                    cls.LIVE_STATUSES)
+                created += cursor.rowcount
+        return created
+
+    @classmethod
+    def claim(cls, status, limit=1, analysis=None, lease=LEASE):
+        """ Claim jobs in the status for this worker
+
+        One conditional UPDATE moves up to `limit` jobs to the transient status
+        (see :data:`CLAIMS`). Jobs claimed by another worker meanwhile don't
+        match its `Status = ?` condition and are not taken twice.
+
+        Args:
+            status (string): NEW or PREPARED
+            limit (Optional[int]): maximum number of jobs
+            analysis (Optional[string]): only jobs of the analysis
+            lease (Optional[float]): seconds the claim lasts unless renewed
+
+        Returns:
+            [Job]: claimed jobs ordered by id, with their runs
+        """
+        candidates = cls.select(cls.id).where(cls.Status == status)
+        if analysis is not None:
+            candidates = candidates.where(cls.Analysis == analysis)
+        candidates = candidates.order_by(cls.id).limit(limit)
+        owner = '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+        now = datetime.datetime.now()
+        claimed = (cls
+                   .update(Status=cls.CLAIMS[status], Owner=owner, Claimed=now,
+                           Expires=now + datetime.timedelta(seconds=lease))
+                   .where((cls.id << candidates) & (cls.Status == status))
+                   .execute())
+        if not claimed:
+            return []
+        return list(cls.select(cls, Run).join(Run).where(cls.Owner == owner).order_by(cls.id))
+
+    def transition(self, status, keep=False, **values):
+        """ Move the job to the status
+
+        The job must still be in the status and have the owner it was read
+        with, e.g. a claim released as stale can't be finished by the
+        worker who lost it.
+
+        Args:
+            status (string): next status, see :data:`TRANSITIONS`
+            keep (Optional[bool]): keep the claim, e.g. a local job stays
+                owned by its scheduler while it runs
+            values: other fields set with the status, e.g. `BatchId`
+
+        Returns:
+            bool: the job has moved
+
+        Raises:
+            ValueError: the transition is not allowed
+        """
+        if status not in self.TRANSITIONS[self.Status]:
+            raise ValueError("Job can't go from %s to %s" % (self.Status, status))
+        fields = dict(values, Status=status)
+        if not keep:
+            fields.update(Owner=None, Claimed=None, Expires=None)
+        if status in self.TIMESTAMPS:
+            fields[self.TIMESTAMPS[status]] = datetime.datetime.now()
+        query = Job.update(**fields).where((Job.id == self.id) & (Job.Status == self.Status))
+        if self.Owner is None:
+            query = query.where(Job.Owner >> None)
+        else:
+            query = query.where(Job.Owner == self.Owner)
+        if not query.execute():
+            return False
+        for name, value in fields.iteritems():
+            setattr(self, name, value)
+        return True
+
+    def renew(self, lease=LEASE):
+        """ Extend the lease of the claimed job
+
+        Args:
+            lease (Optional[float]): seconds the claim lasts from now
+
+        Returns:
+            bool: the job is still claimed by this worker
+        """
+        now = datetime.datetime.now()
+        expires = now + datetime.timedelta(seconds=lease)
+        renewed = (Job.update(Claimed=now, Expires=expires)
+                   .where((Job.id == self.id) & (Job.Owner == self.Owner))
+                   .execute())
+        if renewed:
+            self.Claimed = now
+            self.Expires = expires
+        return bool(renewed)
+
+    @classmethod
+    def peak_rss(cls, analysis, last=50):
+        """ Largest memory of the last done jobs of the analysis
+
+        Args:
+            analysis (string): analysis name
+            last (Optional[int]): number of jobs
+
+        Returns:
+            int: bytes, None if no job has recorded it
+        """
+        query = (cls
+                 .select(cls.MaxRSS)
+                 .where((cls.Analysis == analysis) & (cls.Status == cls.STATUS_DONE) &
+                        ~(cls.MaxRSS >> None))
+                 .order_by(cls.id.desc())
+                 .limit(last))
+        return max([rss for rss, in query.tuples()] or [None])
+
+    def release(self):
+        """ Return the claimed job to the status it had before, see :data:`RELEASES`
+
+        Returns:
+            bool: the job has moved
+        """
+        return self.transition(self.RELEASES[self.Status])
+
+    @classmethod
+    def release_stale(cls):
+        """ Return jobs whose claim has expired to their status
+
+        Each worker sets the lease of its own claims, so a worker with a
+        short lease doesn't release jobs another one still holds.
+
+        Returns:
+            int: number of released jobs
+        """
+        now = datetime.datetime.now()
+        # Claims made before leases were stored last the default lease
+        expired = (cls.Expires < now) | ((cls.Expires >> None) & (
+            cls.Claimed < now - datetime.timedelta(seconds=cls.LEASE)))
+        released = 0
+        for claimed, status in cls.RELEASES.iteritems():
+            # Jobs left to a batch system have no claim and are never stale
+            released += (cls
+                         .update(Status=status, Owner=None, Claimed=None, Expires=None)
+                         .where((cls.Status == claimed) & expired)
+                         .execute())
+        return released
+
+
+def runs_needing_work(analyses, statuses=None, run=None, files=True, failures=None):
+    """ Find runs lacking a job of the analyses
+
+    One query per analysis finds the runs, one more query fetches files of
+    all of them. They are available as `run.Files_prefetch`.
+
+    Args:
+        analyses ([string]): analysis names
+        statuses (Optional[[string]]): only jobs in these statuses count,
+            e.g. failed jobs don't. All jobs count by default
+        run (Optional[int]): only this run number
+        files (Optional[bool]): prefetch files of the runs
+        failures (Optional[int]): skip runs with this many failed jobs of
+            the analysis. No limit by default
+
+    Returns:
+        [(Run, string)]: runs with analysis names ordered by run number
+    """
+    pairs = []
+    for analysis in analyses:
+        jobs = Job.select(Job.id).where((Job.Run == Run.id) & (Job.Analysis == analysis))
+        if statuses is not None:
+            jobs = jobs.where(Job.Status << list(statuses))
+        query = Run.select().where(~fn.EXISTS(jobs))
+        if failures is not None:
+            failed = (Job.select(fn.COUNT(Job.id))
+                      .where((Job.Run == Run.id) & (Job.Analysis == analysis) &
+                             (Job.Status == Job.STATUS_FAILED)))
+            query = query.where(failed < failures)
+        if run is not None:
+            query = query.where(Run.RunNumber == run)
+        pairs += [(db_run, analysis) for db_run in query]
+    if not pairs or not files:
+        return sorted(pairs, key=lambda pair: (pair[0].RunNumber, pair[1]))
+
+    # Runs needing several analyses share their files
+    ids = sorted(set(db_run.id for db_run, _ in pairs))
+    run_files = {}
+    for i in range(0, len(ids), SQLITE_MAX_VARIABLES):
+        for db_run in prefetch(Run.select().where(Run.id << ids[i:i + SQLITE_MAX_VARIABLES]),
+                               File.select().order_by(File.id)):
+            run_files[db_run.id] = db_run.Files_prefetch
+    for db_run, _ in pairs:
+        db_run.Files_prefetch = run_files[db_run.id]
+    return sorted(pairs, key=lambda pair: (pair[0].RunNumber, pair[1]))
+
+
+def bulk_insert(model, rows, ignore=False):
+    """ Insert many rows in one transaction
+
+    One statement is compiled and executed for all rows, as compiling a
+    multi-row insert with peewee costs more than SQLite takes to write it.
+
+    Args:
+        model: model class
+        rows ([dict]): field name -> value, all rows with the same fields
+        ignore (Optional[bool]): skip rows violating a unique constraint
+            (INSERT OR IGNORE)
+    """
+    if not rows:
+        return
+    compiler = db.compiler()
+    fields = [model._meta.fields[name] for name in sorted(rows[0])]
+    sql = 'INSERT %sINTO %s (%s) VALUES (%s)' % (
+        'OR IGNORE ' if ignore else '',
+        compiler.quote(model._meta.db_table),
+        ', '.join(compiler.quote(field.db_column) for field in fields),
+        ', '.join([compiler.interpolation] * len(fields))
+    )
+    with db.atomic():
+        db.get_cursor().executemany(sql, [
+            [field.db_value(row[field.name]) for field in fields] for row in rows
+        ])
+
+
+def _add_columns(model):
+    """ Add columns of the model missing in an existing table
+
+    Only nullable columns can be added, rows stored before get NULL.
+    """
+    compiler = db.compiler()
+    table = model._meta.db_table
+    existing = set(column.name for column in db.get_columns(table))
+    for field in model._meta.get_fields():
+        if field.db_column in existing or not field.null:
+            continue
+        ddl, params = compiler.parse_node(compiler.field_definition(field))
+        db.execute_sql(
+            'ALTER TABLE %s ADD COLUMN %s' % (compiler.quote(table), ddl), params
+        )
+
+
+def _add_indexes(model):
+    """ Create indexes of the model missing in an existing table
+
+    A non-unique index is made unique. If the table has duplicates, a
+    non-unique index is created instead, so lookups are fast anyway, and
+    the unique one is tried again on the next connect.
+    """
+    compiler = db.compiler()
+    table = model._meta.db_table
+    existing = dict((tuple(index.columns), index) for index in db.get_indexes(table))
+    declared = [([field], field.unique) for field in model._fields_to_index()]
+    for names, unique in model._meta.indexes:
+        declared.append(([model._meta.fields[name] for name in names], unique))
+    for fields, unique in declared:
+        columns = tuple(field.db_column for field in fields)
+        index = existing.get(columns)
+        if index is not None and (index.unique or not unique):
+            continue
+        try:
+            with db.atomic():
+                if index is not None:
+                    db.execute_sql('DROP INDEX %s' % compiler.quote(index.name))
+                db.create_index(model, fields, unique)
+        except IntegrityError:
+            warnings.warn("Table %s has duplicate (%s), its index is not unique" %
+                          (table, ', '.join(columns)))
+            if index is None:
+                db.create_index(model, fields, False)
 
 
-def connect(path=None, recreate=False):
+def connect(path=None, recreate=False, profile=None):
     """ Connect to database
     Args:
         path (string): path to the database
         recreate (bool): recreate database? The old database will be rewritten
                          if this flag is set
+        profile (Optional[string]): name of the pragmas profile, see :data:`PROFILES`.
+            By default :data:`DURABILITY_PRAGMAS` aren't changed, the other
+            pragmas of :data:`DEFAULT_PROFILE` are applied
     """
     db_path = path
     if not path:
@@ -76,6 +497,19 @@ def connect(path=None, recreate=False):
         if recreate:
             os.remove(db_path)
 
+    if not db.is_closed():
+        db.close()
     db.database = db_path
+    # SqliteDatabase applies its pragmas to every new connection
+    if profile is None:
+        db._pragmas = [(name, value) for name, value in PROFILES[DEFAULT_PROFILE]
+                       if name not in DURABILITY_PRAGMAS]
+    else:
+        db._pragmas = list(PROFILES[profile])
     db.connect()
-    db.create_tables([Run, Job, Listener, File, Run.Listeners.get_through_model()], not recreate)
+    db.create_tables([Run, Job, Listener, File, ScanMark, Run.Listeners.get_through_model()],
+                     not recreate)
+    for model in [File, Job]:
+        _add_columns(model)
+    for model in [Run, Job, Listener, File]:
+        _add_indexes(model)
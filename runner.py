@@ -0,0 +1,340 @@
+"""
+Event-driven runner of external commands (eos, bsub, job launchers)
+
+A :class:`Runner` drives many processes from one thread. It multiplexes
+their pipes with :func:`select.poll`, so hundreds of listings or job
+monitors don't need a thread each.
+
+.. code-block:: python
+
+    runner = Runner(limit=8)
+    commands = [runner.submit(Command([EOS_CMD, 'ls', path], timeout=60))
+                for path in paths]
+    runner.run()
+    for command in commands:
+        print command.returncode, command.stdout
+
+A command can submit more commands when it ends (see `on_exit`), so
+dependent steps are pipelined without waiting for a whole stage.
+"""
+import os
+import time
+import errno
+import signal
+import select
+import resource
+import collections
+import subprocess
+
+DEFAULT_LIMIT = 8
+""" Default number of slots, a command takes one slot by default """
+RSS_INTERVAL = 1.0
+""" Seconds between measurements of memory of running commands """
+
+_CHUNK = 65536
+
+
+class Command(object):
+    """ External command
+
+    Args:
+        args ([string]): program and its arguments
+        timeout (Optional[float]): seconds after start, the command is killed then
+        cwd (Optional[string]): working directory
+        env (Optional[dict]): environment, inherited by default
+        on_output (Optional[callable]): called as `on_output(command, name, data)`
+            with every chunk read from `stdout` or `stderr`. The output is not
+            kept in the command then
+        on_exit (Optional[callable]): called as `on_exit(command)` when the
+            command has ended, was cancelled or couldn't be started
+        group (Optional[bool]): run in a new session, so the command is killed
+            with all its children and doesn't get signals of the terminal
+        slots (Optional[int]): slots of the runner the command takes, e.g. CPUs
+        rss (Optional[int]): expected peak resident memory, bytes
+    """
+    def __init__(self, args, timeout=None, cwd=None, env=None, on_output=None,
+                 on_exit=None, group=False, slots=1, rss=0):
+        self.args = args
+        self.timeout = timeout
+        self.cwd = cwd
+        self.env = env
+        self.on_output = on_output
+        self.on_exit = on_exit
+        self.group = group
+        self.slots = slots
+        self.rss = rss
+        # Resident memory with children of the session (see `group`), bytes
+        self.measured_rss = 0
+        self.output_bytes = 0
+        # Resource usage of the ended process with its children, see os.wait4
+        self.usage = None
+        self.proc = None
+        self.returncode = None
+        self.error = None
+        self.timed_out = False
+        self.cancelled = False
+        self.started = None
+        self.ended = None
+        self._chunks = {'stdout': [], 'stderr': []}
+
+    @property
+    def stdout(self):
+        return ''.join(self._chunks['stdout'])
+
+    @property
+    def stderr(self):
+        return ''.join(self._chunks['stderr'])
+
+    @property
+    def done(self):
+        return self.ended is not None
+
+    @property
+    def ok(self):
+        """ The command has ended with zero exit code """
+        return self.returncode == 0 and not self.timed_out and not self.cancelled
+
+    def _output(self, name, data):
+        self.output_bytes += len(data)
+        if self.on_output is not None:
+            self.on_output(self, name, data)
+        else:
+            self._chunks[name].append(data)
+
+
+class Runner(object):
+    """ Runs commands concurrently, using at most `limit` slots at once
+
+    Commands start in the order they were submitted, when enough slots and
+    memory are free. A command is accounted with the larger of its expected
+    and measured memory (see :meth:`_measure`). A command exceeding the
+    limits alone runs when nothing else does.
+
+    Args:
+        limit (Optional[int]): number of slots, e.g. CPUs
+        rss (Optional[int]): budget of resident memory of running commands,
+            bytes, unlimited by default
+    """
+    def __init__(self, limit=DEFAULT_LIMIT, rss=None):
+        self.limit = max(1, limit)
+        self.rss = rss
+        self.measured = 0.0
+        self.queue = collections.deque()
+        # command -> number of its pipes still open
+        self.running = {}
+        # fd -> (command, stream name, pipe)
+        self.fds = {}
+        self.poller = select.poll()
+        self.stopped = False
+
+    def __len__(self):
+        """ Number of queued and running commands """
+        return len(self.queue) + len(self.running)
+
+    def submit(self, command):
+        """ Queue the command
+
+        Returns:
+            Command: the same command
+        """
+        self.queue.append(command)
+        return command
+
+    def cancel(self, command):
+        """ Drop the queued command or kill the running one """
+        if command in self.queue:
+            self.queue.remove(command)
+            command.cancelled = True
+            self._finish(command)
+        elif command in self.running:
+            command.cancelled = True
+            self._kill(command)
+
+    def cancel_all(self):
+        for command in list(self.queue) + list(self.running):
+            self.cancel(command)
+
+    def _fits(self, command):
+        """ Enough slots and memory are free to start the command """
+        if not self.running:
+            return True
+        if sum(other.slots for other in self.running) + command.slots > self.limit:
+            return False
+        if self.rss is None:
+            return True
+        used = sum(max(other.rss, other.measured_rss) for other in self.running)
+        return used + command.rss <= self.rss
+
+    def _measure(self):
+        """ Update resident memory of running commands from /proc
+
+        A command in its own session (see `group` of :class:`Command`) is
+        accounted with all its processes, e.g. athena under launcher.sh.
+        """
+        self.measured = time.time()
+        sessions = dict((command.proc.pid, command) for command in self.running
+                        if command.group)
+        processes = dict((command.proc.pid, command) for command in self.running
+                         if not command.group)
+        try:
+            pids = [name for name in os.listdir('/proc') if name.isdigit()]
+        except OSError:
+            # No procfs, only the expected memory is accounted
+            return
+        rss = collections.defaultdict(int)
+        page = resource.getpagesize()
+        for pid in pids:
+            try:
+                with open('/proc/%s/stat' % pid) as f:
+                    stat = f.read()
+            except IOError:
+                # The process has ended meanwhile
+                continue
+            # Fields after the command name, which may contain spaces
+            fields = stat[stat.rindex(')') + 2:].split()
+            command = sessions.get(int(fields[3])) or processes.get(int(pid))
+            if command is not None:
+                rss[command] += int(fields[21]) * page
+        for command in self.running:
+            command.measured_rss = rss.get(command, 0)
+
+    def _start(self, command):
+        command.started = time.time()
+        try:
+            command.proc = subprocess.Popen(
+                command.args, cwd=command.cwd, env=command.env, close_fds=True,
+                preexec_fn=os.setsid if command.group else None,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            )
+        except OSError as err:
+            command.error = err
+            command.returncode = -1
+            self._finish(command)
+            return
+        command.proc.stdin.close()
+        self.running[command] = 2
+        for name, pipe in (('stdout', command.proc.stdout), ('stderr', command.proc.stderr)):
+            self.fds[pipe.fileno()] = (command, name, pipe)
+            self.poller.register(pipe, select.POLLIN | select.POLLPRI)
+
+    def _kill(self, command):
+        try:
+            if command.group:
+                os.killpg(command.proc.pid, signal.SIGKILL)
+            else:
+                command.proc.kill()
+        except OSError:
+            pass
+
+    @staticmethod
+    def _reap(command):
+        """ Reap the ended process with its resource usage
+
+        Returns:
+            bool: the process has ended
+        """
+        try:
+            pid, status, usage = os.wait4(command.proc.pid, os.WNOHANG)
+        except OSError as err:
+            if err.errno != errno.ECHILD:
+                raise
+            # Reaped by someone else, the usage is lost
+            return command.proc.poll() is not None
+        if not pid:
+            return False
+        command.usage = usage
+        if os.WIFSIGNALED(status):
+            command.proc.returncode = -os.WTERMSIG(status)
+        else:
+            command.proc.returncode = os.WEXITSTATUS(status)
+        return True
+
+    def _finish(self, command):
+        command.ended = time.time()
+        if command.on_exit is not None:
+            command.on_exit(command)
+
+    def _read(self, fd):
+        command, name, pipe = self.fds[fd]
+        data = os.read(fd, _CHUNK)
+        if data:
+            command._output(name, data)
+            return
+        self.poller.unregister(fd)
+        pipe.close()
+        del self.fds[fd]
+        self.running[command] -= 1
+
+    def _wait_time(self, timeout):
+        """ Milliseconds to wait in poll, None to wait for output forever """
+        now = time.time()
+        waits = [timeout] if timeout is not None else []
+        for command, open_pipes in self.running.iteritems():
+            if not open_pipes:
+                # The process closed its pipes but may still run
+                waits.append(0.05)
+            if command.timeout is not None:
+                waits.append(command.started + command.timeout - now)
+        if self.queue and self.rss is not None:
+            # Memory of the running commands may drop
+            waits.append(self.measured + RSS_INTERVAL - now)
+        if not waits:
+            return None
+        return max(0, int(min(waits) * 1000))
+
+    def poll(self, timeout=None):
+        """ Start queued commands, read their output and reap ended ones
+
+        Args:
+            timeout (Optional[float]): maximum seconds to wait for output,
+                by default until something happens
+
+        Returns:
+            [Command]: commands ended in this call
+        """
+        if self.queue and self.rss is not None and self.running \
+                and time.time() - self.measured >= RSS_INTERVAL:
+            self._measure()
+        while self.queue and not self.stopped and self._fits(self.queue[0]):
+            self._start(self.queue.popleft())
+        ended = []
+        if self.running:
+            try:
+                events = self.poller.poll(self._wait_time(timeout))
+            except select.error as err:
+                # A signal handler has run, e.g. to stop a scheduler
+                if err.args[0] != errno.EINTR:
+                    raise
+                events = []
+            for fd, _ in events:
+                self._read(fd)
+        now = time.time()
+        for command, open_pipes in self.running.items():
+            if command.timeout is not None and now > command.started + command.timeout \
+                    and not command.timed_out:
+                command.timed_out = True
+                self._kill(command)
+            if open_pipes or not self._reap(command):
+                continue
+            del self.running[command]
+            command.returncode = command.proc.returncode
+            self._finish(command)
+            ended.append(command)
+        return ended
+
+    def run(self):
+        """ Run until all commands, including the ones submitted meanwhile, have ended """
+        try:
+            while self:
+                self.poll()
+        except BaseException:
+            # Interrupted, e.g. by Ctrl-C: don't leave orphan processes
+            self.stopped = True
+            self.cancel_all()
+            while self.running:
+                try:
+                    self.poll()
+                except Exception:
+                    # The first error is reported, later ones are its consequences
+                    pass
+            raise
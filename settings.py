@@ -23,6 +23,11 @@ Search parameters
         }
     ]
 
+Optional search parameters:
+
+* ``lookback`` - how long (in seconds) a run that is still open or has no files
+  yet keeps the listener's high-water mark back, see :func:`caf_find.high_water_mark`
+
 Analysis configuration:
 
 .. code-block:: python
@@ -34,6 +39,10 @@ Analysis configuration:
             "postexec": "RunPlotCalibrationGains.sh"
         }
     ]
+
+Optional analysis parameters:
+
+* ``asetup`` - parameters of the `asetup` command of the analysis' jobs
 """
 
 SCANS = [
@@ -1,2 +1,2 @@
 get_files -jo COOLIdDump.txt
-python {{BASEDIR}}/scripts/RunPlotCalibrationGains.py || (touch error; exit 1)
+python {{BASEDIR}}/scripts/RunPlotCalibrationGains.py || { touch error; exit 1; }
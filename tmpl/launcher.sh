@@ -8,6 +8,6 @@ source $AtlasSetup/scripts/asetup.sh {{ASETUP}}
 
 cat {{OUTPUT}}/jobo.py
 ls -lts
-athena.py {{OUTPUT}}/jobo.py
+athena.py {{OUTPUT}}/jobo.py || exit 1
 
 {{POSTEXEC}}